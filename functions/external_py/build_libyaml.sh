@@ -0,0 +1,17 @@
+#!/usr/bin/env bash
+# Builds the LibYAML bindings (the "_yaml" extension) of the vendored PyYAML
+# next to its python sources, so that the esm-tools can use the C based YAML
+# loader and dumper. Needs Cython and the libyaml headers. If the extension is
+# not built, everything keeps working with the pure Python implementation.
+#
+# Usage: ./build_libyaml.sh   (set PYTHON to choose the interpreter)
+set -e
+PYTHON=${PYTHON:-python}
+cd "$(dirname "$0")/pyyaml"
+if [ "$(${PYTHON} -c 'import sys; print(sys.version_info[0])')" = "2" ]; then
+    target=lib
+else
+    target=lib3
+fi
+${PYTHON} setup.py --with-libyaml build_ext --build-lib ${target}
+${PYTHON} -c "import sys; sys.path.insert(0, '${target}'); import yaml; print('LibYAML bindings available:', yaml.__with_libyaml__)"
@@ -0,0 +1,204 @@
+"""
+Persistent on-disk caches for the esm-tools
+
+Parsing the same ``YAML`` files over and over again for every chunk of an
+experiment is expensive. This module provides a small directory based store
+of pickled entries, which the parser uses to keep fast-to-load binary copies
+of things it has already computed. Every entry carries a *fingerprint* (for
+example the modification time, size and content hash of the file it was
+built from); if the fingerprint does not match on the next lookup, the entry
+is treated as stale and rebuilt.
+
+The total size of each store is bounded. Whenever an entry is written and
+the store grows beyond its limit, the least recently used entries are
+evicted.
+
+The location of all caches can be set with the environment variable
+``ESM_CACHE_DIR``; otherwise ``$XDG_CACHE_HOME/esm_tools`` (or
+``~/.cache/esm_tools``) is used.
+"""
+# Python 2 and 3 version agnostic compatiability:
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import division
+from __future__ import absolute_import
+
+# Python Standard Library imports
+import hashlib
+import logging
+import os
+import sys
+import tempfile
+import threading
+
+# Always import externals before any non standard library imports
+import externals
+
+import six
+from six.moves import cPickle as pickle
+
+# Logger and related constants
+logger = logging.getLogger("root")
+
+# Module Constants:
+CACHE_DIR = os.environ.get(
+    "ESM_CACHE_DIR",
+    os.path.join(
+        os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "esm_tools"
+    ),
+)
+# Pickles are not portable between major python versions:
+CACHE_FLAVOUR = "py%s" % sys.version_info[0]
+CACHE_SUFFIX = ".pickle"
+
+
+def content_hash(content):
+    """
+    Computes a hash of a string (or bytes) suitable for cache fingerprints.
+
+    Parameters
+    ----------
+    content : str or bytes
+        The content to hash
+
+    Returns
+    -------
+    str
+        The hexadecimal SHA1 digest of ``content``
+    """
+    if isinstance(content, six.text_type):
+        content = content.encode("utf-8")
+    return hashlib.sha1(content).hexdigest()
+
+
+class PickleCache(object):
+    """
+    A directory of pickled entries with a size bound and LRU eviction.
+
+    Each entry is stored in its own file, named after a hash of the entry's
+    name. Next to the payload, the entry stores a fingerprint which must match
+    the one given on lookup, otherwise the entry is considered stale.
+
+    Parameters
+    ----------
+    name : str
+        The name of this store. Used as a sub-directory of ``CACHE_DIR``.
+    max_size : int
+        Maximum size of the store on disk in bytes. ``0`` means unbounded.
+    directory : str
+        Use this directory instead of ``CACHE_DIR/name``.
+    """
+
+    def __init__(self, name, max_size=0, directory=None):
+        self.directory = directory or os.path.join(CACHE_DIR, CACHE_FLAVOUR, name)
+        self.max_size = max_size
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        # Stores are also used from the threads of prefetch_config_files:
+        self._lock = threading.Lock()
+
+    def _entry_path(self, name):
+        return os.path.join(self.directory, content_hash(name) + CACHE_SUFFIX)
+
+    def get(self, name, fingerprint):
+        """
+        Returns the payload stored for ``name``, or ``None``.
+
+        ``None`` is returned if the cache is disabled, the entry does not
+        exist, can not be read, or was stored with a different fingerprint.
+        """
+        if not self.enabled:
+            return None
+        entry_path = self._entry_path(name)
+        try:
+            with open(entry_path, "rb") as entry_file:
+                stored_name, stored_fingerprint, payload = pickle.load(entry_file)
+        except (IOError, OSError):
+            self._count(hit=False)
+            return None
+        except Exception as error:
+            # Old or broken entries may fail in all sorts of ways when
+            # unpickling; they are just rebuilt:
+            logger.debug("Ignoring unreadable cache entry %s: %s", entry_path, error)
+            self._count(hit=False)
+            return None
+        if stored_name != name or stored_fingerprint != fingerprint:
+            self._count(hit=False)
+            return None
+        # Mark the entry as recently used for the eviction:
+        try:
+            os.utime(entry_path, None)
+        except OSError:
+            pass
+        self._count(hit=True)
+        return payload
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, name, fingerprint, payload):
+        """
+        Stores ``payload`` under ``name``, and evicts old entries if needed.
+
+        Failures to write (e.g. a read-only file system) are logged and
+        otherwise ignored; the cache is an optimization only.
+        """
+        if not self.enabled:
+            return
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # Write to a temporary file first, so that concurrent readers never
+            # see half written entries:
+            handle, tmp_path = tempfile.mkstemp(
+                dir=self.directory, suffix=CACHE_SUFFIX + ".tmp"
+            )
+            with os.fdopen(handle, "wb") as entry_file:
+                pickle.dump(
+                    (name, fingerprint, payload),
+                    entry_file,
+                    protocol=pickle.HIGHEST_PROTOCOL,
+                )
+            os.rename(tmp_path, self._entry_path(name))
+        except (IOError, OSError, pickle.PicklingError, TypeError) as error:
+            logger.debug("Could not write cache entry for %s: %s", name, error)
+            return
+        if self.max_size:
+            self.evict()
+
+    def evict(self):
+        """
+        Removes least recently used entries until the store fits ``max_size``.
+        """
+        try:
+            entries = []
+            for entry in os.listdir(self.directory):
+                entry_path = os.path.join(self.directory, entry)
+                stat = os.stat(entry_path)
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+        except OSError:
+            return
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(entry_path)
+                total_size -= size
+            except OSError:
+                pass
+
+    def clear(self):
+        """Removes all entries of this store"""
+        if not os.path.isdir(self.directory):
+            return
+        for entry in os.listdir(self.directory):
+            try:
+                os.remove(os.path.join(self.directory, entry))
+            except OSError:
+                pass
@@ -21,11 +21,7 @@ import esm_parser
 class environment_infos:
     def __init__(self):
         self.machine_file = esm_parser.determine_computer_from_hostname()
-        self.config = esm_parser.yaml_file_to_dict(self.machine_file)
-        esm_parser.basic_choose_blocks(self.config, self.config)
-        esm_parser.recursive_run_function(
-            [], self.config, "atomic", esm_parser.find_variable, self.config, [], True
-        )
+        self.config = esm_parser.resolve_machine_config(self.machine_file)
 
     def write_dummy_script(self):
         with open("dummy_script.sh", "w") as script_file:
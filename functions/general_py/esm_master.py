@@ -985,8 +985,22 @@ def main(args):
     parser.add_argument(
         "--version", action="version", version="%(prog)s 3.0 (Oct 01, 2019)"
     )
+    parser.add_argument(
+        "--compile-config-bundle",
+        action="store_true",
+        default=False,
+        help="precompile all yaml configuration files into one bundle file",
+    )
     parsed_args = vars(parser.parse_args())
 
+    if parsed_args.get("compile_config_bundle"):
+        bundled_files = esm_parser.CONFIG_BUNDLE.compile()
+        print(
+            "Compiled %d yaml files into %s"
+            % (len(bundled_files), esm_parser.CONFIG_BUNDLE.path)
+        )
+        sys.exit(0)
+
     check = False
     verbose = 0
     target = ""
@@ -70,16 +70,31 @@ import shutil
 import socket
 import subprocess
 import sys
+import threading
 import warnings
 
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:  # pragma: no cover
+    # Python 2 without the futures backport: prefetching is done serially
+    ThreadPoolExecutor = None
+
 # Always import externals before any non standard library imports
 import externals
 
 from pprint import pformat
 
 import six
+from six.moves import cPickle as pickle
+from six.moves import intern
 
 import esm_backwards_compatability
+import esm_cache
 import esm_sim_objects
 import esm_runscripts
 from esm_profile import *
@@ -111,6 +126,72 @@ esm_master_dir = str(os.path.normpath(os.path.dirname(__file__) + "/../../"))
 
 YAML_AUTO_EXTENSIONS = ["", ".yml", ".yaml", ".YML", ".YAML"]
 
+# Use the LibYAML based loader and dumper if the "_yaml" extension of the
+# vendored PyYAML is built (see external_py/build_libyaml.sh), and fall back to
+# the pure Python implementation otherwise. Both share the same constructors
+# and representers, so the results are identical:
+if getattr(yaml, "__with_libyaml__", False):
+    _YamlLoaderBase, YamlDumper = yaml.CFullLoader, yaml.CDumper
+else:  # pragma: no cover
+    _YamlLoaderBase, YamlDumper = yaml.FullLoader, yaml.Dumper
+
+# Longest string that is interned when loading YAML files (see YamlLoader):
+YAML_INTERN_MAX_LENGTH = 256
+
+# Persistent cache of parsed YAML documents, bounded to 64 MB by default:
+YAML_CACHE_MAX_SIZE = int(os.environ.get("ESM_YAML_CACHE_MAX_SIZE", 64 * 1024 ** 2))
+YAML_DISK_CACHE = esm_cache.PickleCache("yaml", max_size=YAML_CACHE_MAX_SIZE)
+# Process wide cache of parsed YAML documents: path -> (fingerprint, document)
+_yaml_documents = {}
+# All files read by yaml_file_to_dict since the last GeneralConfig was started
+# (or, if it came from the MERGED_CONFIG_CACHE, the files it was read from):
+CONFIG_FILES_READ = []
+
+# Persistent cache of the attached (but not yet resolved) setup and model
+# configs, see ConfigSetup._setup_and_model_configs:
+MERGED_CONFIG_CACHE = esm_cache.PickleCache(
+    "merged_configs", max_size=YAML_CACHE_MAX_SIZE
+)
+MERGED_CONFIG_CACHE_VERSION = 2
+
+# Store of the steps taken to resolve the choose_ blocks of an experiment, a
+# directory next to its config (see choose_memo and resolve_choose_blocks):
+CHOOSE_MEMO_DIR = "choose_memo"
+CHOOSE_MEMO_VERSION = 2
+USE_CHOOSE_MEMO = True
+
+# Persistent cache of machine files with their choose_ blocks and variables
+# resolved, see resolve_machine_config:
+MACHINE_CONFIG_CACHE = esm_cache.PickleCache(
+    "machine_configs", max_size=YAML_CACHE_MAX_SIZE
+)
+MACHINE_CONFIG_CACHE_VERSION = 1
+# Process wide cache of resolved machine files:
+# (path, hostname) -> (fingerprint, config)
+_machine_configs = {}
+
+# Precompiled bundle of all YAML files below FUNCTION_PATH (see ConfigBundle):
+CONFIG_BUNDLE_PATH = FUNCTION_PATH + "/config_bundle.pickle"
+CONFIG_BUNDLE_VERSION = 1
+CONFIG_BUNDLE_SKIP_DIRS = ["external_py", "__pycache__"]
+
+# Number of threads used to prefetch included YAML files:
+PREFETCH_WORKERS = 8
+
+# Number of strings whose result is remembered for each list of regular
+# expressions (see determine_regex_list_match):
+REGEX_MATCH_CACHE_SIZE = 4096
+# Number of strings whose compiled template is remembered (see
+# compile_template):
+TEMPLATE_CACHE_SIZE = 65536
+
+# Directories whose files are looked up through the CONFIG_FILE_INDEX:
+CONFIG_INCLUDE_DIRS = [FUNCTION_PATH] + [
+    directory
+    for directory in os.environ.get("ESM_INCLUDE_PATH", "").split(os.pathsep)
+    if directory
+]
+
 gray_list = [
     r"choose_lresume",
     r"choose_.*lresume",
@@ -145,11 +226,471 @@ def shell_file_to_dict(filepath):
 
 
 
+def use_yaml_cache(enabled=True):
+    """
+    Switches the persistent caches of parsed ``YAML`` documents on or off.
+
+    Parameters
+    ----------
+    enabled : bool
+        Whether or not ``yaml_file_to_dict`` may use the on-disk cache and
+        the config bundle, ``ConfigSetup`` the cache of merged configs
+        and the memo of resolved ``choose_`` blocks, and
+        ``resolve_machine_config`` the cache of resolved machine files.
+    """
+    global USE_CHOOSE_MEMO
+    YAML_DISK_CACHE.enabled = enabled
+    CONFIG_BUNDLE.enabled = enabled
+    MERGED_CONFIG_CACHE.enabled = enabled
+    USE_CHOOSE_MEMO = enabled
+    MACHINE_CONFIG_CACHE.enabled = enabled
+
+
+def intern_string(value):
+    """
+    Interns a string, so that all equal strings share one object.
+
+    Parameters
+    ----------
+    value :
+        Any scalar. Only strings of at most ``YAML_INTERN_MAX_LENGTH``
+        characters are interned, everything else is returned as it is.
+
+    Returns
+    -------
+    tuple
+        The (possibly interned) value, and the number of bytes saved by
+        dropping ``value`` in favour of an already existing copy.
+    """
+    if not isinstance(value, str) or len(value) > YAML_INTERN_MAX_LENGTH:
+        return value, 0
+    interned = intern(value)
+    if interned is value:
+        return value, 0
+    return interned, sys.getsizeof(value)
+
+
+class YamlLoader(_YamlLoaderBase):
+    """
+    The loader used for all YAML files.
+
+    Mapping keys and short string values are interned as they are
+    constructed. The same keys (``namelist_changes``, ``grid``, ``from``,
+    ``to``, ...) and values appear many times across all model configs, and
+    are only stored once this way. The number of bytes saved is counted in
+    the ``interned_bytes`` attribute.
+    """
+
+    def __init__(self, stream):
+        super(YamlLoader, self).__init__(stream)
+        self.interned_bytes = 0
+
+    def construct_yaml_str(self, node):
+        value, saved = intern_string(
+            super(YamlLoader, self).construct_yaml_str(node)
+        )
+        self.interned_bytes += saved
+        return value
+
+
+YamlLoader.add_constructor("tag:yaml.org,2002:str", YamlLoader.construct_yaml_str)
+
+
+def parse_yaml(content):
+    """
+    Parses a ``YAML`` document with the ``YamlLoader``.
+
+    Parameters
+    ----------
+    content : str
+        The text of the document
+
+    Returns
+    -------
+    The parsed document
+    """
+    loader = YamlLoader(content)
+    try:
+        document = loader.get_single_data()
+    finally:
+        loader.dispose()
+    count("yaml interned bytes saved", loader.interned_bytes)
+    return document
+
+
+def load_yaml_document(yaml_file):
+    """
+    Parses an opened ``YAML`` file, using the persistent cache if possible.
+
+    The cache entry for a file is keyed by its absolute path, and is only
+    valid as long as the modification time, size and content hash of the
+    file are unchanged. Otherwise, the file is parsed again and the entry is
+    replaced.
+
+    Parameters
+    ----------
+    yaml_file : file
+        An open file object of the ``YAML`` document
+
+    Returns
+    -------
+    dict
+        A dictionary representation of the yaml file.
+    """
+    content = yaml_file.read()
+    if not YAML_DISK_CACHE.enabled:
+        return parse_yaml(content)
+    stat = os.fstat(yaml_file.fileno())
+    fingerprint = (stat.st_mtime, stat.st_size, esm_cache.content_hash(content))
+    path = os.path.abspath(yaml_file.name)
+    document = YAML_DISK_CACHE.get(path, fingerprint)
+    if document is None:
+        document = parse_yaml(content)
+        YAML_DISK_CACHE.put(path, fingerprint, document)
+    return document
+
+
+def copy_document(document):
+    """
+    Makes a structural copy of a parsed ``YAML`` document.
+
+    All dictionaries, lists and sets are copied, while the (immutable)
+    scalars are shared with the original. This is much cheaper than
+    ``copy.deepcopy``, and enough to allow the copy to be modified in place.
+
+    Parameters
+    ----------
+    document :
+        The parsed document, or any part of it
+
+    Returns
+    -------
+    A copy of ``document``
+    """
+    if isinstance(document, dict):
+        return {key: copy_document(value) for key, value in six.iteritems(document)}
+    if isinstance(document, list):
+        return [copy_document(item) for item in document]
+    if isinstance(document, set):
+        return set(document)
+    return document
+
+
+def load_yaml_file(filepath):
+    """
+    Loads a single ``YAML`` file, parsing it only once per process.
+
+    Parsed documents are kept in a process wide cache, keyed by absolute
+    path, for as long as the modification time and size of the file do not
+    change. Every caller gets its own structural copy of the document (see
+    ``copy_document``), so the result can be modified in place.
+
+    Parameters
+    ----------
+    filepath : str
+        The exact path of the YAML file
+
+    Returns
+    -------
+    dict
+        A dictionary representation of the yaml file.
+
+    Raises
+    ------
+    IOError, OSError
+        If the file can not be found or read.
+    """
+    path = os.path.abspath(filepath)
+    stat = os.stat(path)
+    fingerprint = (stat.st_mtime, stat.st_size)
+    cached = _yaml_documents.get(path)
+    if cached and cached[0] == fingerprint:
+        count("yaml cache hits")
+        return copy_document(cached[1])
+    count("yaml cache misses")
+    document = CONFIG_BUNDLE.get(path, stat)
+    if document is None:
+        with open(path) as yaml_file:
+            document = load_yaml_document(yaml_file)
+    _yaml_documents[path] = (fingerprint, document)
+    return copy_document(document)
+
+
+def yaml_cache_info():
+    """
+    Returns the hit and miss counters of the caches of parsed YAML documents.
+
+    Returns
+    -------
+    dict
+        ``hits`` and ``misses`` of the in-process cache, ``documents``
+        currently held by it, and ``disk_hits`` and ``disk_misses`` of the
+        persistent cache.
+    """
+    return {
+        "hits": counters.get("yaml cache hits", 0),
+        "misses": counters.get("yaml cache misses", 0),
+        "documents": len(_yaml_documents),
+        "disk_hits": YAML_DISK_CACHE.hits,
+        "disk_misses": YAML_DISK_CACHE.misses,
+    }
+
+
+def clear_yaml_cache():
+    """Empties the in-process cache of parsed YAML documents"""
+    _yaml_documents.clear()
+
+
+class ConfigBundle(object):
+    """
+    All ``YAML`` files of the esm-tools, precompiled into a single file.
+
+    A coupled setup needs hundreds of small files (components, setups,
+    machines, batch systems, ...). The bundle stores the parsed documents of
+    all of them in one pickle, which is read once per process, the first time
+    a file is loaded. The bundle is created with ``compile``, e.g. by running
+    ``esm_master --compile-config-bundle``.
+
+    Every entry carries the modification time, size and content hash of its
+    source file. If the modification time or size differ, the source file is
+    hashed again; if the content changed, the entry is ignored and the file
+    is parsed as usual.
+
+    Parameters
+    ----------
+    path : str
+        Where the bundle is stored
+    root : str
+        The directory containing all files in the bundle. Entries are stored
+        relative to this directory, so the bundle stays valid if the whole
+        directory is copied (e.g. into the experiment's script folder).
+    """
+
+    def __init__(self, path, root):
+        self.path = path
+        self.root = os.path.abspath(root)
+        self.enabled = True
+        self._documents = None
+        # The bundle is first needed by the threads of prefetch_config_files,
+        # which must not all read it at once:
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def header():
+        return {"version": CONFIG_BUNDLE_VERSION, "python": sys.version_info[0]}
+
+    @property
+    def documents(self):
+        if self._documents is None:
+            with self._lock:
+                if self._documents is None:
+                    self._documents = self._read()
+        return self._documents
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as bundle_file:
+                header, documents = pickle.load(bundle_file)
+        except (IOError, OSError):
+            return {}
+        except Exception as error:
+            logger.warning("Ignoring unreadable config bundle %s: %s", self.path, error)
+            return {}
+        if header != self.header():
+            logger.warning(
+                "Ignoring config bundle %s of another version, please recompile it",
+                self.path,
+            )
+            return {}
+        return documents
+
+    def get(self, path, stat):
+        """
+        Returns the bundled document of a file, or ``None``.
+
+        Parameters
+        ----------
+        path : str
+            The absolute path of the source file
+        stat :
+            The result of ``os.stat(path)``
+
+        Returns
+        -------
+        The parsed document, or ``None`` if the file is not in the bundle or
+        the bundled version is outdated.
+        """
+        if not self.enabled:
+            return None
+        entry = self.documents.get(os.path.relpath(path, self.root))
+        if entry is None:
+            return None
+        mtime, size, digest, document = entry
+        if (stat.st_mtime, stat.st_size) != (mtime, size):
+            with open(path) as source_file:
+                if esm_cache.content_hash(source_file.read()) != digest:
+                    logger.debug("Bundled version of %s is outdated", path)
+                    count("config bundle outdated")
+                    return None
+        count("config bundle hits")
+        return document
+
+    def compile(self):
+        """
+        Parses all YAML files below ``root`` and writes them into the bundle.
+
+        Files that can not be parsed are skipped with a warning.
+
+        Returns
+        -------
+        list
+            The files that were put into the bundle, relative to ``root``.
+        """
+        documents = {}
+        directories = [self.root]
+        while directories:
+            directory = directories.pop()
+            for name in sorted(os.listdir(directory)):
+                path = os.path.join(directory, name)
+                if os.path.isdir(path):
+                    if name not in CONFIG_BUNDLE_SKIP_DIRS:
+                        directories.append(path)
+                    continue
+                if not name.endswith(tuple(YAML_AUTO_EXTENSIONS[1:])):
+                    continue
+                with open(path) as source_file:
+                    content = source_file.read()
+                    stat = os.fstat(source_file.fileno())
+                try:
+                    document = parse_yaml(content)
+                except yaml.YAMLError as error:
+                    logger.warning("Not bundling %s: %s", path, error)
+                    continue
+                documents[os.path.relpath(path, self.root)] = (
+                    stat.st_mtime,
+                    stat.st_size,
+                    esm_cache.content_hash(content),
+                    document,
+                )
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as bundle_file:
+            pickle.dump(
+                (self.header(), documents),
+                bundle_file,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        os.rename(tmp_path, self.path)
+        self._documents = documents
+        return sorted(documents)
+
+
+CONFIG_BUNDLE = ConfigBundle(CONFIG_BUNDLE_PATH, FUNCTION_PATH)
+
+
+class ConfigFileIndex(object):
+    """
+    An index of the files in the configuration directories.
+
+    Looking for files that do not exist is expensive on the parallel file
+    systems of most supercomputers. Therefore, each directory below one of
+    the ``directories`` is listed once (using ``os.scandir``) the first time
+    a file in it is looked up, and all further lookups are answered from that
+    listing, without trying to open any files.
+
+    A directory is only listed again if a file can not be found and the
+    directory was modified since it was listed, or if a listed file turns out
+    to be gone (see ``forget``). Files in other directories are looked up
+    directly.
+
+    Parameters
+    ----------
+    directories : list
+        The directories (including all their subdirectories) to index.
+    """
+
+    def __init__(self, directories):
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self._listings = {}
+
+    def covers(self, directory):
+        """Checks if files in ``directory`` are looked up in the index"""
+        for root in self.directories:
+            if directory == root or directory.startswith(root + os.sep):
+                return True
+        return False
+
+    def _scan(self, directory):
+        try:
+            mtime = os.stat(directory).st_mtime
+            if hasattr(os, "scandir"):
+                names = set(
+                    entry.name for entry in os.scandir(directory) if entry.is_file()
+                )
+            else:  # pragma: no cover
+                names = set(
+                    name
+                    for name in os.listdir(directory)
+                    if os.path.isfile(os.path.join(directory, name))
+                )
+        except OSError:
+            mtime, names = None, set()
+        self._listings[directory] = (mtime, names)
+        return names
+
+    def find(self, filepath, extensions=("",)):
+        """
+        Finds a file, trying all given extensions in order.
+
+        Parameters
+        ----------
+        filepath : str
+            The path of the file, possibly without extension
+        extensions : list
+            Extensions to try appending to ``filepath``.
+
+        Returns
+        -------
+        str or None
+            The path of the first file that exists, or ``None`` if none of
+            them exist.
+        """
+        directory, name = os.path.split(os.path.abspath(filepath))
+        if not self.covers(directory):
+            for extension in extensions:
+                if os.path.isfile(filepath + extension):
+                    return filepath + extension
+            return None
+        listing = self._listings.get(directory)
+        names = self._scan(directory) if listing is None else listing[1]
+        for extension in extensions:
+            if name + extension in names:
+                return os.path.join(directory, name + extension)
+        if listing is not None:
+            try:
+                mtime = os.stat(directory).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != listing[0]:
+                self.forget(filepath)
+                return self.find(filepath, extensions)
+        return None
+
+    def forget(self, filepath):
+        """Drops the listing of the directory containing ``filepath``"""
+        directory = os.path.dirname(os.path.abspath(filepath))
+        self._listings.pop(directory, None)
+
+
+CONFIG_FILE_INDEX = ConfigFileIndex(CONFIG_INCLUDE_DIRS)
+
+
 def yaml_file_to_dict(filepath):
     """
     Given a yaml file, returns a corresponding dictionary.
 
-    If you do not give an extension, tries again after appending one.
+    If you do not give an extension, tries again after appending one. The
+    file is looked up in the ``CONFIG_FILE_INDEX``, so no extensions are
+    tried that do not exist.
 
     Parameters
     ----------
@@ -161,21 +702,117 @@ def yaml_file_to_dict(filepath):
     dict
         A dictionary representation of the yaml file.
     """
-    for extension in YAML_AUTO_EXTENSIONS:
+    path = CONFIG_FILE_INDEX.find(filepath, YAML_AUTO_EXTENSIONS)
+    if path:
         try:
-            with open(filepath + extension) as yaml_file:
-                return yaml.load(yaml_file, Loader=yaml.FullLoader)
-        except IOError as error:
-            logger.debug(
-                "IOError (%s) File not found with %s, trying another extension pattern.",
-                error.errno,
-                filepath + extension,
-            )
+            document = load_yaml_file(path)
+        except (IOError, OSError) as error:
+            # The file might have been removed after its directory was listed:
+            logger.debug("IOError (%s) reading %s, looking again.", error.errno, path)
+            CONFIG_FILE_INDEX.forget(path)
+            path = CONFIG_FILE_INDEX.find(filepath, YAML_AUTO_EXTENSIONS)
+            if path:
+                document = load_yaml_file(path)
+        if path:
+            CONFIG_FILES_READ.append(os.path.abspath(path))
+            return document
     raise FileNotFoundError(
         "All file extensions tried and none worked for %s" % filepath
     )
 
 
+def list_included_files(document):
+    """
+    Lists the files a config includes via ``include_models`` or ``further_reading``.
+
+    Both keywords are looked for on the top level of ``document`` and in its
+    ``general`` chapter. Paths are determined in the same way as in
+    ``attach_to_config_and_reduce_keyword`` and ``attach_single_config``.
+
+    Parameters
+    ----------
+    document : dict
+        A parsed (but not yet attached) YAML document
+
+    Returns
+    -------
+    list
+        Paths of all included files which exist.
+    """
+    included_files = []
+    if not isinstance(document, dict):
+        return included_files
+    chapters = [document]
+    if isinstance(document.get("general"), dict):
+        chapters.append(document["general"])
+    for chapter in chapters:
+        include_models = chapter.get("include_models", [])
+        if isinstance(include_models, list):
+            for item in include_models:
+                included_files.append(
+                    CONFIG_FILE_INDEX.find(
+                        FUNCTION_PATH + "/" + item.split(".")[0] + "/" + item,
+                        YAML_AUTO_EXTENSIONS,
+                    )
+                )
+        further_reading = chapter.get("further_reading", [])
+        if isinstance(further_reading, str):
+            further_reading = [further_reading]
+        for item in further_reading:
+            try:
+                path, value = item.rsplit("/", 1)
+            except ValueError:
+                path, value = ".", item
+            included_files.append(
+                CONFIG_FILE_INDEX.find(FUNCTION_PATH + "/" + path + "/" + value)
+                or CONFIG_FILE_INDEX.find(path + "/" + value)
+            )
+    return [path for path in included_files if path]
+
+
+def _prefetch_yaml_file(filepath):
+    try:
+        return load_yaml_file(filepath)
+    except (IOError, OSError, yaml.YAMLError) as error:
+        # Any errors are raised again once the file is really needed:
+        logger.debug("Could not prefetch %s: %s", filepath, error)
+        return None
+
+
+def prefetch_config_files(filepaths):
+    """
+    Loads YAML files and everything they include concurrently.
+
+    The files are read and parsed on a pool of ``PREFETCH_WORKERS`` threads
+    and end up in the in-process cache of ``load_yaml_file``, so that the
+    subsequent attach and merge steps, which still happen one after the other
+    in their usual order, do not need to touch the disk anymore. Includes are
+    discovered level by level; all files of one level are loaded at once.
+
+    Parameters
+    ----------
+    filepaths : list
+        The files to start with
+    """
+    seen = set()
+    pending = list(filepaths)
+    pool = ThreadPoolExecutor(PREFETCH_WORKERS) if ThreadPoolExecutor else None
+    try:
+        while pending:
+            pending = sorted(set(path for path in pending if path) - seen)
+            seen.update(pending)
+            if pool:
+                documents = list(pool.map(_prefetch_yaml_file, pending))
+            else:  # pragma: no cover
+                documents = [_prefetch_yaml_file(path) for path in pending]
+            pending = []
+            for document in documents:
+                pending += list_included_files(document)
+    finally:
+        if pool:
+            pool.shutdown()
+
+
 def pprint_config(config):  # pragma: no cover
     """
     Prints the dictionary given to the stdout in a nicely formatted YAML style.
@@ -189,8 +826,8 @@ def pprint_config(config):  # pragma: no cover
     -------
     None
     """
-    yaml.Dumper.ignore_aliases = lambda *args: True
-    print(yaml.dump(config, default_flow_style=False))
+    YamlDumper.ignore_aliases = lambda *args: True
+    print(yaml.dump(config, default_flow_style=False, Dumper=YamlDumper))
 
 
 def attach_to_config_and_reduce_keyword(
@@ -278,19 +915,19 @@ def attach_to_config_and_reduce_keyword(
 
 
 def attach_single_config(config, path, attach_value):
-    if os.path.isfile(FUNCTION_PATH + "/" + path + "/" + attach_value):
-        attachable_config = yaml_file_to_dict(
-            FUNCTION_PATH + "/" + path + "/" + attach_value
-        )
-    elif os.path.isfile(path + "/" + attach_value):
-        attachable_config = yaml_file_to_dict(
-            path + "/" + attach_value
-        )
+    attach_file = CONFIG_FILE_INDEX.find(
+        FUNCTION_PATH + "/" + path + "/" + attach_value
+    ) or CONFIG_FILE_INDEX.find(path + "/" + attach_value)
+    if attach_file:
+        attachable_config = yaml_file_to_dict(attach_file)
     else:
         print ("Could not find ", path + "/" + attach_value)
         sys.exit(1)
     #DB this is a try:
-    dict_merge(config, attachable_config)
+    count(
+        "dict_merge entries touched: " + os.path.relpath(attach_file, FUNCTION_PATH),
+        dict_merge(config, attachable_config),
+    )
     #config.update(attachable_config)
 
 
@@ -359,31 +996,44 @@ def priority_merge_dicts(first_config, second_config, priority="first"):
     #        if not priority_marker in inner_key:
     #            to_merge[key][inner_key+priority_marker] = to_merge[key][inner_key]
     #            del to_merge[key][inner_key]
-    dict_merge(merged_dictionary, to_merge)
+    count(
+        "dict_merge entries touched: priority merges",
+        dict_merge(merged_dictionary, to_merge),
+    )
     return merged_dictionary
 
 
-def dict_merge(dct, merge_dct):
-    """ Recursive dict merge. Inspired by :meth:``dict.update()``, instead of
-    updating only top-level keys, dict_merge recurses down into dicts nested
+def dict_merge(dct, merge_dct, index=None, path=()):
+    """ Deep dict merge. Inspired by :meth:``dict.update()``, instead of
+    updating only top-level keys, dict_merge walks down into dicts nested
     to an arbitrary depth, updating keys. The ``merge_dct`` is merged into
-    ``dct``.
+    ``dct``. Nested dicts are walked in the same order as a recursive merge
+    would, but with an explicit stack, so that there is no depth limit.
     :param dct: dict onto which the merge is executed
     :param merge_dct: dct merged into dct
-    :return: None
+    :param index: a ``NestedKeyIndex`` the merged keys are added to
+    :param path: where ``dct`` is in the mapping of ``index``
+    :return: The number of entries of ``merge_dct`` (at all levels) touched
     """
-    for k, v in six.iteritems(merge_dct):
-        if (
-            k in dct
-            and isinstance(dct[k], dict)
-            and isinstance(merge_dct[k], collections.Mapping)
-        ):
-            dict_merge(dct[k], merge_dct[k])
+    touched = 0
+    stack = [(dct, six.iteritems(merge_dct))]
+    while stack:
+        target, items = stack[-1]
+        for k, v in items:
+            touched += 1
+            current = target.get(k)
+            if isinstance(current, dict) and isinstance(v, Mapping):
+                stack.append((current, six.iteritems(v)))
+                break
+            target[k] = v
         else:
-            dct[k] = merge_dct[k]
+            stack.pop()
+    if index is not None:
+        index.add(path, merge_dct)
+    return touched
 
 
-def deep_update(chapter, entries, config, blackdict={}):
+def deep_update(chapter, entries, config, blackdict={}, index=None, path=()):
     # if "remove_" in chapter:
     #    remove_chapter = chapter.replace("remove_", "")
     #    remove_entries_from_chapter(config, remove_chapter, entries)
@@ -395,11 +1045,168 @@ def deep_update(chapter, entries, config, blackdict={}):
     #    del config[chapter]
     # else:
     if chapter not in blackdict:
-        dict_merge(config, {chapter: entries})
+        dict_merge(config, {chapter: entries}, index, path)
+
+
+class NestedKeyIndex(object):
+    """
+    An index of all keys of a dict of dicts.
+
+    Every key is mapped to the paths (tuples of keys, starting from the top
+    of the indexed ``mapping``) of the dicts it appears in. The index is
+    built with a single walk over ``mapping``; afterwards, finding, deleting
+    or listing keys only looks at the dicts the key was seen in, instead of
+    walking the whole tree every time.
+
+    Entries that are later merged into the mapping have to be announced with
+    ``add`` (``dict_merge`` does so if it is given the index). Keys which are
+    deleted or overwritten do not have to be: every path is looked up again
+    when it is used, and skipped if the key is no longer there. The order of
+    the keys is also taken from the mapping as it is then, so an index kept
+    up to date this way lists the same keys in the same order as a new one.
+
+    Parameters
+    ----------
+    mapping : dict
+        The nested dictionary to index
+    """
 
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self._paths = {}
+        self.add((), mapping)
+
+    def add(self, path, mapping):
+        """
+        Indexes the keys of ``mapping``, which is (merged into) the dict at
+        ``path``, and of all dicts nested in it.
+        """
+        stack = [(tuple(path), mapping)]
+        while stack:
+            path, mapping = stack.pop()
+            for key in list(mapping):
+                value = mapping[key]
+                self._paths.setdefault(key, set()).add(path)
+                if isinstance(value, dict):
+                    stack.append((path + (key,), value))
+
+    def _get(self, path):
+        mapping = self.mapping
+        for key in path:
+            if not isinstance(mapping, dict) or key not in mapping:
+                return None
+            mapping = mapping[key]
+        return mapping if isinstance(mapping, dict) else None
+
+    def _in_walk_order(self, entries):
+        """
+        Sorts ``(path, key)`` pairs in the order in which the ``find_*_entries``
+        functions walk the mapping now, and drops those no longer set.
+
+        Such a walk takes the dicts from a stack: all keys of a dict come
+        before those of the dicts nested in it, and the dicts nested under
+        later keys come first.
+        """
+        positions = {}
+
+        def positions_in(path):
+            if path not in positions:
+                parent = self._get(path)
+                positions[path] = (
+                    None
+                    if parent is None
+                    else dict((key, number) for number, key in enumerate(parent))
+                )
+            return positions[path]
+
+        ordered = []
+        for path, key in entries:
+            keys = positions_in(path)
+            if keys is None or key not in keys:
+                continue
+            rank = tuple(
+                -positions_in(path[:depth])[path[depth]] for depth in range(len(path))
+            )
+            ordered.append(((rank, keys[key]), path, key))
+        ordered.sort(key=lambda entry: entry[0])
+        return [(path, key) for _, path, key in ordered]
+
+    def locations(self, key, below=()):
+        """
+        Lists where ``key`` is set, uppermost dicts first.
+
+        Parameters
+        ----------
+        key :
+            The key to look for
+        below : tuple
+            Only look in the dict at this path, and the dicts nested in it
+
+        Returns
+        -------
+        list
+            Tuples of ``(path, parent)``, the dict ``parent`` at ``path``
+            containing ``key``.
+        """
+        below = tuple(below)
+        entries = self._in_walk_order(
+            (path, key)
+            for path in self._paths.get(key, ())
+            if path[: len(below)] == below
+        )
+        entries.sort(key=lambda entry: len(entry[0]))
+        return [(path, self._get(path)) for path, _ in entries]
+
+    def find(self, key, below=()):
+        """
+        Returns the value of the uppermost ``key`` below the path ``below``.
+
+        Raises
+        ------
+        KeyError
+            If ``key`` is not set anywhere below ``below``.
+        """
+        for _, parent in self.locations(key, below):
+            return parent[key]
+        raise KeyError(key)
+
+    def delete(self, key):
+        """Deletes ``key`` from all dicts it is set in"""
+        for path, parent in self.locations(key):
+            # A parent deleted together with an upper occurrence is gone:
+            if self._get(path) is parent and key in parent:
+                del parent[key]
+        self._paths.pop(key, None)
+
+    def prefixed(self, prefix, below=()):
+        """
+        Lists all keys starting with ``prefix`` below the path ``below``.
+
+        Returns
+        -------
+        list
+            Tuples of ``(path, key, value)``, in the order in which a walk
+            over the mapping finds them.
+        """
+        below = tuple(below)
+        entries = self._in_walk_order(
+            (path, key)
+            for key, paths in six.iteritems(self._paths)
+            if isinstance(key, str) and key.startswith(prefix)
+            for path in paths
+            if path[: len(below)] == below
+        )
+        return [(path, key, self._get(path)[key]) for path, key in entries]
 
-def find_remove_entries_in_config(mapping, model_name):
+
+def find_remove_entries_in_config(mapping, model_name, index=None):
     all_removes = []
+    if index is not None:
+        for _, key, value in index.prefixed("remove_", (model_name,)):
+            if not "." in key:
+                key = "remove_" + model_name + "." + key.split("remove_")[-1]
+            all_removes.append((key, value))
+        return all_removes
     mappings = [mapping]
     while mappings:
         mapping = mappings.pop()
@@ -427,16 +1234,18 @@ def remove_entries_from_chapter(config, remove_chapter, remove_entries):
             pass
 
 
-def add_entries_from_chapter(config, add_chapter, add_entries):
+def add_entries_from_chapter(config, add_chapter, add_entries, index=None):
     my_entries = copy.deepcopy(add_entries)
     if add_chapter in config:
         if type(config[add_chapter]) == list:
             for entry in my_entries:
                 config[add_chapter].append(entry)
         elif type(config[add_chapter]) == dict:
-            dict_merge(config[add_chapter], add_entries)
+            dict_merge(config[add_chapter], add_entries, index, (add_chapter,))
     else:
         config[add_chapter] = add_entries
+        if index is not None:
+            index.add((), {add_chapter: add_entries})
 
 def remove_entry_from_chapter(
     remove_chapter,
@@ -482,12 +1291,14 @@ def remove_entry_from_chapter(
 
 
 def remove_entries_from_chapter_in_config(
-    model_config, valid_model_names, setup_config, valid_setup_names
+    model_config, valid_model_names, setup_config, valid_setup_names, index=None
 ):
     config = model_config
     for model in valid_model_names:
         logging.debug(model)
-        all_removes_for_model = find_remove_entries_in_config(config[model], model)
+        all_removes_for_model = find_remove_entries_in_config(
+            config[model], model, index
+        )
         for remove_chapter, remove_entries in all_removes_for_model:
             model_to_remove_from = remove_chapter.split(".")[0].replace("remove_", "")
             remove_entry_from_chapter(
@@ -504,8 +1315,10 @@ def remove_entries_from_chapter_in_config(
                 pass
 
 
-def basic_find_remove_entries_in_config(mapping):
+def basic_find_remove_entries_in_config(mapping, index=None):
     all_removes = []
+    if index is not None:
+        return [(key, value) for _, key, value in index.prefixed("remove_")]
     mappings = [mapping]
     while mappings:
         mapping = mappings.pop()
@@ -523,8 +1336,10 @@ def basic_find_remove_entries_in_config(mapping):
     return all_removes
 
 
-def basic_find_add_entries_in_config(mapping):
+def basic_find_add_entries_in_config(mapping, index=None):
     all_adds = []
+    if index is not None:
+        return [(key, value) for _, key, value in index.prefixed("add_")]
     mappings = [mapping]
     while mappings:
         mapping = mappings.pop()
@@ -544,8 +1359,14 @@ def basic_find_add_entries_in_config(mapping):
     return all_adds
 
 
-def find_add_entries_in_config(mapping, model_name):
+def find_add_entries_in_config(mapping, model_name, index=None):
     all_adds = []
+    if index is not None:
+        for _, key, value in index.prefixed("add_", (model_name,)):
+            if not "." in key:
+                key = "add_" + model_name + "." + key.split("add_")[-1]
+            all_adds.append((key, value))
+        return all_adds
     mappings = [mapping]
     while mappings:
         mapping = mappings.pop()
@@ -575,6 +1396,7 @@ def add_entry_to_chapter(
     model_with_add_statement,
     model_config,
     setup_config,
+    index=None,
 ):
 
     if model_to_add_to in model_config:
@@ -602,6 +1424,15 @@ def add_entry_to_chapter(
         target_config[model_to_add_to][
             add_chapter.split(".")[-1].replace("add_", "")
         ] = source_config[model_with_add_statement][source_chapter]
+        if index is not None and target_config is index.mapping:
+            index.add(
+                (model_to_add_to,),
+                {
+                    add_chapter.split(".")[-1].replace("add_", ""): source_config[
+                        model_with_add_statement
+                    ][source_chapter]
+                },
+            )
     else:
         if not type(
             target_config[model_to_add_to][
@@ -630,6 +1461,14 @@ def add_entry_to_chapter(
                 target_config[model_to_add_to][
                     add_chapter.split(".")[-1].replace("add_", "")
                 ].update(add_entries)
+                if index is not None and target_config is index.mapping:
+                    index.add(
+                        (
+                            model_to_add_to,
+                            add_chapter.split(".")[-1].replace("add_", ""),
+                        ),
+                        add_entries,
+                    )
     if list_counter > 1:
         pass
         # pdb.set_trace()
@@ -638,24 +1477,26 @@ def add_entry_to_chapter(
     # del source_config[model_with_add_statement][source_chapter.replace("add_", "")]
 
 
-def basic_add_entries_to_chapter_in_config(config):
-    all_adds_for_model = basic_find_add_entries_in_config(config)
+def basic_add_entries_to_chapter_in_config(config, index=None):
+    all_adds_for_model = basic_find_add_entries_in_config(config, index)
     for add_chapter, add_entries in all_adds_for_model:
-        add_entries_from_chapter(config, add_chapter.replace("add_", ""), add_entries)
+        add_entries_from_chapter(
+            config, add_chapter.replace("add_", ""), add_entries, index
+        )
 
-def basic_remove_entries_from_chapter_in_config(config):
-    all_removes_for_model = basic_find_remove_entries_in_config(config)
+def basic_remove_entries_from_chapter_in_config(config, index=None):
+    all_removes_for_model = basic_find_remove_entries_in_config(config, index)
     for remove_chapter, remove_entries in all_removes_for_model:
         remove_entries_from_chapter(config, remove_chapter.replace("remove_", ""), remove_entries)
 
 
 def add_entries_to_chapter_in_config(
-    model_config, valid_model_names, setup_config, valid_setup_names
+    model_config, valid_model_names, setup_config, valid_setup_names, index=None
 ):
     config = model_config
     for model in list(config):
         logging.debug(model)
-        all_adds_for_model = find_add_entries_in_config(config[model], model)
+        all_adds_for_model = find_add_entries_in_config(config[model], model, index)
         for add_chapter, add_entries in all_adds_for_model:
             model_to_add_to = add_chapter.split(".")[0].replace("add_", "")
             add_entry_to_chapter(
@@ -665,6 +1506,7 @@ def add_entries_to_chapter_in_config(
                 model,
                 model_config,
                 setup_config,
+                index,
             )
 
 
@@ -691,7 +1533,7 @@ def merge_dicts(*dict_args):
     return result
 
 
-def del_value_for_nested_key(config, key):
+def del_value_for_nested_key(config, key, index=None):
     """
     In a dict of dicts, delete a key/value pair.
 
@@ -701,11 +1543,17 @@ def del_value_for_nested_key(config, key):
         The dict to delete in.
     key : str
         The key to delete.
+    index : NestedKeyIndex, optional
+        An index of ``config``; if given, only the dicts containing ``key``
+        are looked at.
 
     Warning
     -------
     The ``config`` is modified **in place**!
     """
+    if index is not None:
+        index.delete(key)
+        return
     if key in config:
         del config[key]
     for v in config.values():
@@ -759,30 +1607,25 @@ def find_value_for_nested_key(mapping, key_of_interest, tree=[]):
 
 
 def basic_choose_blocks(config_to_resolve, config_to_search, isblacklist=True):
-    all_set_variables = {}
+    index = NestedKeyIndex(config_to_resolve)
+    graph = ChooseGraph(config_to_resolve, None, gray_list, isblacklist)
     while True:
-        name_chooses = basic_list_all_keys_starting_with_choose(
-            config_to_resolve, gray_list, isblacklist
-        )
-        if name_chooses == []:
+        task = graph.next_task()
+        if task is None:
             break
-        for key, block in name_chooses:
-            all_set_variables[key] = basic_determine_set_variables_in_choose_block(
-                block
-            )
-
-        task_list = choose_key = basic_find_one_independent_choose(all_set_variables)
-        logging.debug("The task list is: %s", task_list)
-        logging.debug("all_set_variables: %s", all_set_variables)
-        resolve_basic_choose(config_to_search, config_to_resolve, choose_key)
-        del all_set_variables[choose_key]
-        for key in list(all_set_variables):
-            if not all_set_variables[key]:
-                del all_set_variables[key]
-        logging.debug("Remaining all_set_variables=%s", all_set_variables)
+        logging.debug("The next task is: %s", task)
+        _, choose_key = task
+        applied_entries = resolve_basic_choose(
+            config_to_search,
+            config_to_resolve,
+            choose_key,
+            block=graph.blocks[task],
+            index=index,
+        )
+        graph.resolved(None, choose_key, applied_entries)
 
-    basic_add_entries_to_chapter_in_config(config_to_resolve)
-    basic_remove_entries_from_chapter_in_config(config_to_resolve)
+    basic_add_entries_to_chapter_in_config(config_to_resolve, index)
+    basic_remove_entries_from_chapter_in_config(config_to_resolve, index)
 
 
 def basic_list_all_keys_starting_with_choose(mapping, ignore_list, isblacklist):
@@ -899,218 +1742,878 @@ def determine_set_variables_in_choose_block(config, valid_model_names, model_nam
     return set_variables
 
 
-def basic_find_one_independent_choose(all_set_variables):
-    """
-    Given a dictionary of ``all_set_variables``, which comes out of the
-    function ``determine_set_variables_in_choose_block``, gives a list of
-    task/variable dependencies to resolve in order to figure out the variable.
-
-    Parameter, self.configs
-    ----------
-    all_set_variables : dict
-
-    Returns
-    -------
-    task_list : list
-        A list of tuples comprising ``(model_name, var_name)`` in order to
-        resolve one ``choose_`` block. This list is built in such a way that
-        the beginning of the list provides dependencies for later on in the
-        list.
-    """
-    task_list = []
-    for choose_keyword in list(all_set_variables):
-        # for choose_keyword, set_vars in six.iteritems(value):
-        task_list.append(choose_keyword)
-        task_list = basic_add_more_important_tasks(
-            choose_keyword, all_set_variables, task_list
-        )
-        logging.debug(task_list)
-        return task_list[0]
+# Returned by ChooseBlock.select if no case of a block applies:
+NO_CASE = object()
 
 
-def find_one_independent_choose(all_set_variables):
+class ChooseBlock(object):
     """
-    Given a dictionary of ``all_set_variables``, which comes out of the
-    function ``determine_set_variables_in_choose_block``, gives a list of
-    task/variable dependencies to resolve in order to figure out the variable.
+    A ``choose_`` block, compiled for repeated lookups.
+
+    The selector (the dotted path after ``choose_``) is split once, the
+    ``"*"`` case is looked up once, and the variables set by the block are
+    determined once (see ``determine_set_variables_in_choose_block``).
+    Choosing a case is then a walk down the selector path and a single
+    dictionary lookup.
 
     Parameters
     ----------
-    all_set_variables : dict
+    choose_key : str
+        The key of the block, e.g. ``"choose_computer.cores_per_node"``
+    cases : dict
+        The value of the block, mapping choices to the entries to set
+    valid_model_names : list, optional
+        Names of all chapters. Only if given, the set variables are
+        determined.
+    model_name : str, optional
+        The chapter the block belongs to; ``general`` if not given
+    """
 
-    Returns
-    -------
-    task_list : list
-        A list of tuples comprising ``(model_name, var_name)`` in order to
-        resolve one ``choose_`` block. This list is built in such a way that
-        the beginning of the list provides dependencies for later on in the
-        list.
-    """
-    task_list = []
-    for key in all_set_variables:
-        value = all_set_variables[key]
-        choose_keywords = list(value)
-        for choose_keyword in choose_keywords:
-            set_vars = value[choose_keyword]
-            task_list.append((key, choose_keyword))
-            task_list = add_more_important_tasks(
-                choose_keyword, all_set_variables, task_list
+    def __init__(self, choose_key, cases, valid_model_names=None, model_name=None):
+        self.key = choose_key
+        self.selector = tuple(choose_key.replace("choose_", "").split("."))
+        self.cases = cases
+        self.has_default = "*" in cases
+        self.default = cases.get("*")
+        self.set_variables = set()
+        if valid_model_names is not None:
+            self.set_variables.update(
+                var_name
+                for _, var_name in determine_set_variables_in_choose_block(
+                    cases, valid_model_names, model_name
+                )
             )
-            logging.debug(task_list)
-            return task_list[0]
 
+    def nested_keys(self, model_name):
+        """
+        Returns the keys of all ``choose_`` blocks nested in the cases, in the
+        form ``"choose_<name>.x"`` they get once they are read into the
+        chapter ``model_name``.
+        """
+        nested_keys = []
+        stack = [self.cases]
+        while stack:
+            entry = stack.pop()
+            if not isinstance(entry, dict):
+                continue
+            for key, value in six.iteritems(entry):
+                if isinstance(key, str) and key.startswith("choose_"):
+                    if model_name is not None and "." not in key:
+                        key = key.replace("choose_", "choose_" + model_name + ".", 1)
+                    nested_keys.append(key)
+                stack.append(value)
+        return nested_keys
+
+    def choice(self, config):
+        """
+        Returns the value the block chooses on in ``config``.
+
+        Raises
+        ------
+        ValueError
+            If the selector path does not exist in ``config``, like
+            ``recursive_get``.
+        """
+        value = config
+        for part in self.selector:
+            try:
+                value = value[part]
+            except Exception:
+                raise ValueError(
+                    "Exactly None! Couldn't find an answer for:", list(self.selector)
+                )
+        return value
 
-def resolve_basic_choose(config, config_to_replace_in, choose_key, blackdict={}):
-    path_to_key = choose_key.replace("choose_", "").split(".")
-    try:
-        choice = recursive_get(config, path_to_key)
-    except ValueError:
-        if "*" not in config_to_replace_in[choose_key]:
-            raise KeyError("Key %s was not defined", path_to_key)
-        else:
-            del config_to_replace_in[choose_key]
-            return
-    if isinstance(choice, str) and "${" in choice:
-        logging.warning("Variable %s as a choice, skipping...", choice)
-        del config_to_replace_in[choose_key]
-        return
-    logging.debug(choice)
+    def select(self, config):
+        """
+        Returns the key of the case which applies for ``config``.
 
-    if choice in config_to_replace_in.get(choose_key):
-        for update_key, update_value in six.iteritems(
-            config_to_replace_in[choose_key][choice]
-        ):
-            deep_update(update_key, update_value, config_to_replace_in, blackdict)
+        Returns ``NO_CASE`` if the choice is not defined but there is a
+        ``"*"`` case, if the choice still contains a variable, or if no case
+        matches the choice.
 
-    elif "*" in config_to_replace_in.get(choose_key):
-        logging.debug("Found a * case!")
-        for update_key, update_value in six.iteritems(
-            config_to_replace_in[choose_key]["*"]
-        ):
-            deep_update(update_key, update_value, config_to_replace_in, blackdict)
-    else:
+        Raises
+        ------
+        KeyError
+            If the choice is not defined, and there is no ``"*"`` case.
+        """
+        try:
+            choice = self.choice(config)
+        except ValueError:
+            if not self.has_default:
+                raise KeyError("Key %s was not defined", list(self.selector))
+            return NO_CASE
+        if isinstance(choice, str) and "${" in choice:
+            logging.warning("Variable %s as a choice, skipping...", choice)
+            return NO_CASE
+        logging.debug(choice)
+        if choice in self.cases:
+            return choice
+        if self.has_default:
+            logging.debug("Found a * case!")
+            return "*"
         logging.warning("Choice %s could not be resolved", choice)
-        logging.warning("Key was key=%s", choose_key)
-
-    del config_to_replace_in[choose_key]
-
+        logging.warning("Key was key=%s", self.key)
+        return NO_CASE
 
-def resolve_choose(model_with_choose, choose_key, config):
-    if model_with_choose in config:
-        config_to_replace_in = config
-    else:
-        raise KeyError("Something is horribly wrong")
-    model_name, key = choose_key.replace("choose_", "").split(".")
-    choice = config.get(model_with_choose).get(key)
-
-    config_to_search_in = {}
 
-    if model_name in config:
-        config_to_search_in = config
-
-    if not config_to_search_in:
-        raise KeyError("Something else is horribly wrong")
+def resolve_basic_choose(
+    config, config_to_replace_in, choose_key, blackdict={}, block=None, index=None
+):
+    """
+    Resolves one ``choose_`` block of ``config_to_replace_in``, and removes it.
 
-    if key in config_to_search_in[model_name]:
-        choice = config_to_search_in[model_name][key]
-        logging.debug(model_with_choose)
-        logging.debug(choice)
+    Parameters
+    ----------
+    config : dict
+        The configuration to look up the choice in
+    config_to_replace_in : dict
+        The chapter containing the block; the entries of the chosen case are
+        merged into it
+    choose_key : str
+    blackdict : dict
+        Entries which must not be overwritten
+    block : ChooseBlock
+        The compiled block, if it is already available
+    index : NestedKeyIndex, optional
+        An index of ``config_to_replace_in``, kept up to date
 
-        logging.debug("key=%s", key)
+    Returns
+    -------
+    dict or None
+        The entries of the chosen case, which were merged into
+        ``config_to_replace_in``, or ``None`` if no case applied.
+    """
+    if block is None:
+        block = ChooseBlock(choose_key, config_to_replace_in[choose_key])
+    return apply_choose_case(
+        config_to_replace_in, choose_key, block.select(config), blackdict, index
+    )
 
 
-def basic_add_more_important_tasks(choose_keyword, all_set_variables, task_list):
+def apply_choose_case(
+    config_to_replace_in, choose_key, case, blackdict={}, index=None, path=()
+):
     """
-    Determines dependencies of a choose keyword.
+    Merges one case of a ``choose_`` block into its chapter, and removes the
+    block.
 
     Parameters
     ----------
-    choose_keyword : str
-        The keyword, starting with choose, which is looked through to check if
-        there are any dependencies that must be resolved first to correctly
-        resolve this one.
-    all_set_variables : dict
-        All variables that can be set
-    task_list : list
-        A list in the order in which tasks must be resolved for
-        ``choose_keyword`` to make sense.
+    config_to_replace_in : dict
+        The chapter containing the block
+    choose_key : str
+    case :
+        The key of the case to apply, as returned by ``ChooseBlock.select``;
+        if it is ``NO_CASE``, the block is only removed.
+    blackdict : dict
+        Entries which must not be overwritten
+    index : NestedKeyIndex, optional
+        An index the merged entries are added to
+    path : tuple
+        Where ``config_to_replace_in`` is in the mapping of ``index``
 
     Returns
     -------
-    task_list
-        A list of choices which must be made in order for choose_keyword to
-        make sense.
-    """
-    keyword = choose_keyword.replace("choose_", "")
-    for choose_thing in all_set_variables:
-        logging.debug("Choose_thing = %s", choose_thing)
-        for keyword_that_is_set in all_set_variables[choose_thing]:
-            if keyword_that_is_set == keyword:
-                if choose_thing not in task_list:
-                    task_list.insert(0, choose_thing)
-                    basic_add_more_important_tasks(
-                        choose_thing, all_set_variables, task_list
-                    )
-                    return task_list
-                else:
-                    raise KeyError("Opps cyclic dependency: %s" % task_list)
-    return task_list
+    dict or None
+        The entries of the case, or ``None`` if no case applied.
+    """
+    applied_entries = None
+    if case is not NO_CASE:
+        applied_entries = config_to_replace_in[choose_key][case]
+    if applied_entries is not None:
+        for update_key, update_value in six.iteritems(applied_entries):
+            deep_update(
+                update_key, update_value, config_to_replace_in, blackdict, index, path
+            )
+    del config_to_replace_in[choose_key]
+    return applied_entries
 
 
-def add_more_important_tasks(choose_keyword, all_set_variables, task_list):
+def find_cycles(nodes, edges, ignore=()):
     """
-    Determines dependencies of a choose keyword.
+    Finds all cyclic dependencies in a directed graph.
+
+    The strongly connected components of the graph are determined with
+    Tarjan's algorithm, in a single pass over all nodes and their edges.
+    Every component with more than one node, or with a node depending on
+    itself, contains at least one cycle.
 
     Parameters
     ----------
-    choose_keyword : str
-        The keyword, starting with choose, which is looked through to check if
-        there are any dependencies that must be resolved first to correctly
-        resolve this one.
-    all_set_variables : dict
-        All variables that can be set
-    task_list : list
-        A list in the order in which tasks must be resolved for
-        ``choose_keyword`` to make sense.
+    nodes : list
+        All nodes of the graph, in order
+    edges : dict
+        The nodes each node depends on, in order
+    ignore : set
+        Components containing any of these nodes are not reported
 
     Returns
     -------
-    task_list
-        A list of choices which must be made in order for choose_keyword to
-        make sense.
-    """
-    keyword = choose_keyword.replace("choose_", "")
-    if "cores_per_node" in keyword:
-        pass  # pdb.set_trace()
-    for model in all_set_variables:
-        for choose_thing in all_set_variables[model]:
-            # logging.debug("Choose_thing = %s", choose_thing)
-            for (host, keyword_that_is_set) in all_set_variables[model][choose_thing]:
-                if (
-                    keyword_that_is_set == keyword
-                    or keyword_that_is_set == keyword.replace(model + ".", "")
-                ):
-                    if (model, choose_thing) not in task_list:
-                        task_list.insert(0, (model, choose_thing))
-                        add_more_important_tasks(
-                            choose_thing, all_set_variables, task_list
-                        )
-                        return task_list
-                    else:
-                        raise KeyError("Opps cyclic dependency: %s" % task_list)
-    return task_list
+    list
+        One list of nodes per cycle, in the order in which they depend on
+        each other and closed by the first node again, starting with the
+        first node of the component. Cycles are sorted by their first node.
+        Empty if there are no cycles.
+    """
+    position = dict((node, number) for number, node in enumerate(nodes))
+    index = {}
+    lowlink = {}
+    on_stack = set()
+    stack = []
+    components = []
+    for root in nodes:
+        if root in index:
+            continue
+        index[root] = lowlink[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(edges[root]))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = lowlink[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(edges[successor])))
+                    break
+                if successor in on_stack:
+                    lowlink[node] = min(lowlink[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == index[node]:
+                    component = set()
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.add(member)
+                        if member == node:
+                            break
+                    if (
+                        len(component) > 1 or node in edges[node]
+                    ) and not component & set(ignore):
+                        components.append(component)
+    cycles = []
+    for component in components:
+        # Walk along the dependencies inside the component until a node
+        # comes up again; that closes one cycle through it:
+        cycle = [min(component, key=position.get)]
+        while True:
+            node = next(
+                successor for successor in edges[cycle[-1]] if successor in component
+            )
+            if node in cycle:
+                cycles.append(cycle[cycle.index(node) :] + [node])
+                break
+            cycle.append(node)
+    return sorted(cycles, key=lambda cycle: position[cycle[0]])
 
 
-def recursive_run_function(tree, right, level, func, *args, **kwargs):
-    """ Recursively runs func on all nested dicts.
+class ChooseGraph(object):
+    """
+    The dependencies between all ``choose_`` blocks of a config.
 
-    Tree is a list starting at the top of the config dictionary, where it will
-    be labeled "top"
+    A ``choose_`` block depends on every other block which sets the variable
+    it chooses on (see ``determine_set_variables_in_choose_block``): blocks
+    setting e.g. ``echam.resolution`` under that name, and blocks of the
+    ``echam`` chapter setting ``resolution``. The blocks and the variables
+    they set are determined once, and indexed by variable. After a block is
+    resolved, only its own chapter is looked at again, and only if the
+    chosen case brought in new ``choose_`` blocks.
+
+    A config without chapters, like a machine file, is a single chapter
+    named ``None``. Its blocks keep their keys, and choose on the variable
+    of that name at the top of the config (see ``basic_choose_blocks``).
 
     Parameters
     ----------
-    tree : list
-        Where in the dictionary you are
+    config : dict
+        The complete configuration, with one chapter per name
+    names : list or None
+        The names of all chapters, in order; ``None`` if ``config`` has no
+        chapters
+    ignore_list : list
+        Regular expressions of ``choose_`` keys to skip, see
+        ``list_all_keys_starting_with_choose``
+    isblacklist : bool
+    trace : list, optional
+        If given, ``("scan", name)`` is appended to it whenever a chapter is
+        (re-)read, see ``replay_choose_trace``.
+    """
+
+    def __init__(self, config, names, ignore_list, isblacklist, trace=None):
+        self.config = config
+        self.trace = trace
+        # Names of chapters blocks can set variables in:
+        self.chapter_names = names or []
+        if names is None:
+            names = [None]
+        self.names = names
+        self.name_index = {name: index for index, name in enumerate(names)}
+        self.ignore_list = ignore_list
+        self.isblacklist = isblacklist
+        # name -> choose keys of that chapter, in order:
+        self.chooses = {}
+        # (name, choose key) -> compiled block:
+        self.blocks = {}
+        # variable -> blocks setting it:
+        self.setters = {}
+        # (name, choose key) -> sort key:
+        self.order = {}
+        self._sequence = 0
+        for name in names:
+            self.scan(name)
+        self._reordered = False
+
+    def scan(self, name):
+        """(Re-)reads all ``choose_`` blocks of one chapter"""
+        if self.trace is not None:
+            self.trace.append(("scan", name))
+        for key in self.chooses.get(name, []):
+            self._forget((name, key))
+        self.chooses[name] = []
+        if name is None:
+            chooses = basic_list_all_keys_starting_with_choose(
+                self.config, self.ignore_list, self.isblacklist
+            )
+        else:
+            chooses = list_all_keys_starting_with_choose(
+                self.config[name], name, self.ignore_list, self.isblacklist
+            )
+        for key, block in chooses:
+            node = (name, key)
+            if node in self.order:
+                # Renaming "choose_x" to "choose_<name>.x" replaced a block
+                # already there; it keeps its place:
+                self._forget(node, keep_order=True)
+            else:
+                self.chooses[name].append(key)
+                self._sequence += 1
+                self.order[node] = (self.name_index[name], self._sequence)
+            self.blocks[node] = compiled = ChooseBlock(
+                key, block, self.chapter_names, name
+            )
+            for var_name in compiled.set_variables:
+                self.setters.setdefault(var_name, set()).add(node)
+
+    def _reorder(self, name):
+        """Sorts the blocks of a chapter by their (current) position in it"""
+        chapter = self.config if name is None else self.config[name]
+        position = {key: index for index, key in enumerate(chapter)}
+        self.chooses[name].sort(key=position.get)
+        for key in self.chooses[name]:
+            self._sequence += 1
+            self.order[(name, key)] = (self.name_index[name], self._sequence)
+
+    def _forget(self, node, keep_order=False):
+        block = self.blocks.pop(node, None)
+        if block:
+            for var_name in block.set_variables:
+                self.setters[var_name].discard(node)
+        if not keep_order:
+            del self.order[node]
+
+    def dependencies(self, choose_key):
+        """
+        Returns the set of all blocks that set the variable ``choose_key``
+        chooses on.
+        """
+        keyword = choose_key.replace("choose_", "")
+        candidates = set(self.setters.get(keyword, ()))
+        for name in self.chapter_names:
+            if name + "." in keyword:
+                for node in self.setters.get(keyword.replace(name + ".", ""), ()):
+                    if node[0] == name:
+                        candidates.add(node)
+        return candidates
+
+    def dependency(self, choose_key):
+        """
+        Returns the first block, in config order, that sets the variable
+        ``choose_key`` chooses on, or ``None``.
+        """
+        candidates = self.dependencies(choose_key)
+        if candidates:
+            return min(candidates, key=self.order.get)
+        return None
+
+    def cycles(self):
+        """
+        Finds all cyclic dependencies between the blocks.
+
+        The strongly connected components of the graph are determined with
+        Tarjan's algorithm, in a single pass over all blocks and their
+        dependencies. Every component with more than one block, or with a
+        block depending on itself, can never be resolved -- unless one of
+        its blocks is replaced by a ``choose_`` block of the same name nested
+        in a case of another one. Such cycles are left to ``next_task``.
+
+        Returns
+        -------
+        list
+            One list of blocks ``(name, choose_key)`` per cycle, in the
+            order in which they depend on each other, starting with the first
+            block of the config. Empty if there are no cycles.
+        """
+        nodes = sorted(self.order, key=self.order.get)
+        edges = {
+            node: sorted(self.dependencies(node[1]), key=self.order.get)
+            for node in nodes
+        }
+        replaceable = set()
+        for name, key in nodes:
+            for nested_key in self.blocks[(name, key)].nested_keys(name):
+                replaceable.add((name, nested_key))
+        return find_cycles(nodes, edges, replaceable)
+
+    def next_task(self):
+        """
+        Returns the next block to resolve as a tuple ``(name, choose_key)``.
+
+        This is the first block of the config which does not depend on any
+        other, or which the first remaining block depends on (directly or
+        indirectly). Returns ``None`` once all blocks are resolved.
+
+        Raises
+        ------
+        KeyError
+            If the blocks depend on each other in a cycle.
+        """
+        for name in self.names:
+            if self.chooses.get(name):
+                task_list = [(name, self.chooses[name][0])]
+                break
+        else:
+            return None
+        while True:
+            dependency = self.dependency(task_list[0][1])
+            if dependency is None:
+                return task_list[0]
+            if dependency in task_list:
+                raise KeyError("Opps cyclic dependency: %s" % task_list)
+            task_list.insert(0, dependency)
+
+    def resolved(self, name, choose_key, applied_entries):
+        """
+        Removes a resolved block from the graph.
+
+        If the entries applied by resolving it contain ``choose_`` blocks,
+        the chapter is read again.
+        """
+        self.chooses[name].remove(choose_key)
+        self._forget((name, choose_key))
+        if not self._reordered:
+            # Keys of the form "choose_x" were moved to the end of their
+            # chapter when they were renamed during the first scan; from now
+            # on, the blocks are taken in the order of the chapter:
+            for chapter_name in self.names:
+                self._reorder(chapter_name)
+            self._reordered = True
+        if applied_entries and any(
+            isinstance(key, str) and key.startswith("choose_")
+            for key in applied_entries
+        ):
+            self.scan(name)
+
+
+def describe_choose_cycles(cycles, paths=()):
+    """
+    Describes cyclic dependencies between ``choose_`` blocks for an error.
+
+    Parameters
+    ----------
+    cycles : list
+        Cycles as returned by ``ChooseGraph.cycles``
+    paths : list
+        The ``YAML`` files the config was read from. Those defining a block
+        of a cycle are named in the description.
+
+    Returns
+    -------
+    str
+    """
+    descriptions = []
+    for cycle in cycles:
+        description = " -> ".join(name + "." + key for name, key in cycle)
+        files = []
+        for name, key in cycle[:-1]:
+            for path in _files_defining_choose(name, key, paths):
+                if path not in files:
+                    files.append(path)
+        if files:
+            description += " (defined in %s)" % ", ".join(files)
+        descriptions.append(description)
+    return "Opps cyclic dependency between choose_ blocks: %s" % "; ".join(
+        descriptions
+    )
+
+
+def _files_defining_choose(name, choose_key, paths):
+    # The key might have been renamed from "choose_x" to "choose_<name>.x"
+    # while it was read:
+    keys = set([choose_key, choose_key.replace("choose_" + name + ".", "choose_")])
+    found = []
+    for path in paths:
+        try:
+            document = load_yaml_file(path)
+        except (IOError, OSError):
+            continue
+        stack = [document]
+        while stack:
+            entry = stack.pop()
+            if not isinstance(entry, dict):
+                continue
+            if keys.intersection(entry):
+                found.append(os.path.relpath(path, FUNCTION_PATH))
+                break
+            stack.extend(entry.values())
+    return found
+
+
+def choose_fingerprint(config, blackdict={}, isblacklist=True):
+    """
+    Fingerprints the structure of the ``choose_`` blocks of ``config``.
+
+    These are the blocks of every chapter (with all nested blocks), in
+    order, and the entries of the ``blackdict``. Two configs with the same
+    fingerprint resolve the same cases of the same blocks in the same order,
+    as long as the blocks choose on the same values (see
+    ``validate_choose_trace``), even if their other entries differ.
+
+    Parameters
+    ----------
+    config : dict
+    blackdict : dict
+    isblacklist : bool
+
+    Returns
+    -------
+    str
+    """
+    blocks = []
+    for name, chapter in six.iteritems(config):
+        if not isinstance(chapter, dict):
+            continue
+        chapter_blocks = [
+            (key, value)
+            for key, value in six.iteritems(chapter)
+            if isinstance(key, str) and key.startswith("choose_")
+        ]
+        blocks.append((name, chapter_blocks, list(blackdict.get(name, {}))))
+    return esm_cache.content_hash(repr((isblacklist, blocks)))
+
+
+def _recorded_choice(block, config):
+    # The value a block chooses on, as kept in a trace; () if it is undefined:
+    try:
+        return (block.choice(config),)
+    except ValueError:
+        return ()
+
+
+def validate_choose_trace(config, trace):
+    """
+    Checks how much of a recorded trace still applies to ``config``.
+
+    The blocks of a trace are resolved in the same way as long as every
+    block chooses on the same value as when the trace was recorded. Values
+    set by the cases applied before are taken from the trace; all others
+    are looked up in ``config``, which is not modified. Values which are
+    merged from several dictionaries are not checked; the trace is
+    considered to end there.
+
+    Parameters
+    ----------
+    config : dict
+        A config with the same ``choose_fingerprint`` as the one the trace
+        was recorded for
+    trace : list
+        As recorded by ``resolve_choose_blocks``
+
+    Returns
+    -------
+    int
+        The number of steps at the start of the trace which still apply,
+        ``len(trace)`` if all of them do.
+    """
+    written = {}
+    for index, step in enumerate(trace):
+        if step[0] == "scan":
+            continue
+        model_with_choose, choose_key, recorded = step[1:4]
+        block = ChooseBlock(choose_key, {})
+        top = block.selector[:2]
+        if top in written:
+            merged, value = written[top]
+            if merged:
+                return index
+            try:
+                for part in block.selector[2:]:
+                    value = value[part]
+                choice = (value,)
+            except Exception:
+                choice = ()
+        else:
+            choice = _recorded_choice(block, config)
+        # 1 == 1.0 == True, but they do not choose the same case:
+        if choice != recorded or [type(item) for item in choice] != [
+            type(item) for item in recorded
+        ]:
+            return index
+        if step[0] == "apply":
+            for update_key, merged, update_value in step[5]:
+                written[(model_with_choose, update_key)] = (merged, update_value)
+    return len(trace)
+
+
+def replay_choose_trace(config, trace, blackdict={}, isblacklist=True, index=None):
+    """
+    Resolves the ``choose_`` blocks of ``config`` by repeating a trace
+    recorded by ``resolve_choose_blocks``.
+
+    Chapters are read (renaming their ``choose_`` keys) and cases applied
+    in exactly the same order as when the trace was recorded, without
+    working out the dependencies again. This is only correct for a config
+    with the same ``choose_fingerprint``, for which all of the trace is
+    still valid (see ``validate_choose_trace``).
+
+    Parameters
+    ----------
+    config : dict
+        The complete configuration, modified **in place**
+    trace : list
+        ``("scan", name)``, ``("apply", name, choose_key, choice, case,
+        writes)`` and ``("drop", name, choose_key, choice)`` steps
+    blackdict : dict
+    isblacklist : bool
+    index : NestedKeyIndex, optional
+        An index of ``config``, kept up to date
+    """
+    for step in trace:
+        if step[0] == "scan":
+            list_all_keys_starting_with_choose(
+                config[step[1]], step[1], gray_list, isblacklist
+            )
+            continue
+        _apply_choose_step(config, step, blackdict, index)
+
+
+def _apply_choose_step(config, step, blackdict, index=None):
+    model_with_choose, choose_key = step[1:3]
+    if model_with_choose in blackdict:
+        model_blackdict = blackdict[model_with_choose]
+    else:
+        model_blackdict = {}
+    if step[0] == "apply":
+        case = step[4]
+    else:
+        case = NO_CASE
+    return apply_choose_case(
+        config[model_with_choose],
+        choose_key,
+        case,
+        model_blackdict,
+        index,
+        (model_with_choose,),
+    )
+
+
+def choose_memo(config):
+    """
+    Returns the store of recorded ``choose_`` resolutions of an experiment.
+
+    The store is the directory ``CHOOSE_MEMO_DIR`` in the config directory
+    of the experiment (``general.experiment_config_dir``), so that it is
+    removed together with the experiment, and never shared with others.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration of the experiment
+
+    Returns
+    -------
+    esm_cache.PickleCache or None
+        ``None`` if the config directory is not known (yet) or can not be
+        written to, or the store is switched off with ``use_yaml_cache``.
+        Each of these is logged, so that a memo which is never used does not
+        go unnoticed.
+    """
+    if not USE_CHOOSE_MEMO:
+        logger.debug("Not memoizing choose_ blocks: switched off")
+        return None
+    config_dir = config.get("general", {}).get("experiment_config_dir")
+    if not isinstance(config_dir, str) or "${" in config_dir:
+        logger.debug(
+            "Not memoizing choose_ blocks: general.experiment_config_dir is not "
+            "known (%s)",
+            config_dir,
+        )
+        return None
+    directory = os.path.join(config_dir, CHOOSE_MEMO_DIR)
+    # The store creates its directory when it is first written to, so the
+    # closest one that already exists must be writable:
+    existing = directory
+    while not os.path.isdir(existing) and os.path.dirname(existing) != existing:
+        existing = os.path.dirname(existing)
+    if not os.access(existing, os.W_OK):
+        logger.warning(
+            "Not memoizing choose_ blocks: %s can not be written to", existing
+        )
+        return None
+    return esm_cache.PickleCache(
+        CHOOSE_MEMO_DIR, max_size=YAML_CACHE_MAX_SIZE, directory=directory
+    )
+
+
+def _resolve_choose_graph(config, graph, blackdict, steps=(), index=None):
+    # Resolves all blocks of the graph; the given (valid) steps of a
+    # recorded trace are taken first, instead of working them out:
+    trace = graph.trace
+    for step in steps:
+        if step[0] == "scan":
+            # The graph reads the chapters itself:
+            continue
+        if trace is not None:
+            trace.append(step)
+        applied_entries = _apply_choose_step(config, step, blackdict, index)
+        graph.resolved(step[1], step[2], applied_entries)
+    while True:
+        task = graph.next_task()
+        if task is None:
+            break
+        model_with_choose, choose_key = task
+        logging.debug("Resolving %s of %s", choose_key, model_with_choose)
+        if model_with_choose in blackdict:
+            model_blackdict = blackdict[model_with_choose]
+        else:
+            model_blackdict = {}
+        block = graph.blocks[task]
+        case = block.select(config)
+        if trace is not None:
+            choice = _recorded_choice(block, config)
+            if case is NO_CASE:
+                trace.append(("drop", model_with_choose, choose_key, choice))
+            else:
+                # What the case writes, to check later traces without the
+                # blocks (see validate_choose_trace). The blackdict may share
+                # the chapter, so this is done before the case is applied:
+                writes = tuple(
+                    (update_key, isinstance(update_value, Mapping), update_value)
+                    for update_key, update_value in six.iteritems(
+                        block.cases[case] or {}
+                    )
+                    if update_key not in model_blackdict
+                )
+                trace.append(
+                    ("apply", model_with_choose, choose_key, choice, case, writes)
+                )
+        applied_entries = apply_choose_case(
+            config[model_with_choose],
+            choose_key,
+            case,
+            model_blackdict,
+            index,
+            (model_with_choose,),
+        )
+        graph.resolved(model_with_choose, choose_key, applied_entries)
+
+
+def resolve_choose_blocks(
+    config, blackdict={}, isblacklist=True, memo=None, index=None
+):
+    """
+    Resolves all ``choose_`` blocks in all chapters of ``config``.
+
+    Blocks are resolved in the order of their dependencies (see
+    ``ChooseGraph``); afterwards, all ``add_`` and ``remove_`` entries are
+    applied. Those are looked up in a ``NestedKeyIndex`` of ``config``,
+    which is built before the first block is resolved, and to which the
+    entries of every applied case are added as they are merged.
+
+    If a ``memo`` store is given, the resolution steps are kept in it under
+    the ``choose_fingerprint`` of the config, together with the value each
+    block chose on. For the next config with the same fingerprint, e.g. in
+    the next chunk of the experiment, the steps are just repeated (see
+    ``replay_choose_trace``). If some blocks now choose on other values (like
+    ``lresume`` after the first chunk), the steps up to the first of those
+    are repeated, and only the rest is worked out again.
+
+    Parameters
+    ----------
+    config : dict
+        The complete configuration, modified **in place**
+    blackdict : dict
+        Entries set by the user or the setup, which the blocks of the
+        corresponding chapter must not overwrite
+    isblacklist : bool
+        Whether or not to skip ``choose_`` keys matching the ``gray_list``
+    memo : esm_cache.PickleCache, optional
+        Store of recorded resolutions, see ``choose_memo``
+    index : NestedKeyIndex, optional
+        An index of ``config``, built if not given
+
+    Raises
+    ------
+    KeyError
+        If the blocks depend on each other in cycles. All cycles are
+        reported at once, before any block is resolved.
+    """
+    all_names = list(config)
+    if index is None:
+        index = NestedKeyIndex(config)
+    trace = None
+    valid_steps = []
+    if memo is not None and memo.enabled:
+        fingerprint = choose_fingerprint(config, blackdict, isblacklist)
+        recorded_trace = memo.get(fingerprint, CHOOSE_MEMO_VERSION) or []
+        valid = validate_choose_trace(config, recorded_trace)
+        if recorded_trace and valid == len(recorded_trace):
+            count("choose memo hits")
+            replay_choose_trace(
+                config, recorded_trace, blackdict, isblacklist, index
+            )
+            _add_and_remove_entries(config, all_names, index)
+            return
+        count("choose memo misses")
+        valid_steps = recorded_trace[:valid]
+        count(
+            "choose memo steps reused",
+            len([step for step in valid_steps if step[0] != "scan"]),
+        )
+        trace = []
+    graph = ChooseGraph(config, all_names, gray_list, isblacklist, trace)
+    # Fail before anything is resolved if the blocks can never be resolved:
+    cycles = graph.cycles()
+    if cycles:
+        raise KeyError(describe_choose_cycles(cycles, CONFIG_FILES_READ))
+    _resolve_choose_graph(config, graph, blackdict, valid_steps, index)
+    if trace is not None:
+        memo.put(fingerprint, CHOOSE_MEMO_VERSION, trace)
+    _add_and_remove_entries(config, all_names, index)
+
+
+def _add_and_remove_entries(config, all_names, index):
+    # Both passes look up their keys in the same index, instead of walking
+    # all chapters twice:
+    add_entries_to_chapter_in_config(config, all_names, config, all_names, index)
+    remove_entries_from_chapter_in_config(config, all_names, config, all_names, index)
+
+
+def recursive_run_function(tree, right, level, func, *args, **kwargs):
+    """ Recursively runs func on all nested dicts.
+
+    Tree is a list starting at the top of the config dictionary, where it will
+    be labeled "top"
+
+    Parameters
+    ----------
+    tree : list
+        Where in the dictionary you are
     right :
         The value of the last key in `tree`
     level : str, one of "mappings", "atomic", "always"
@@ -1237,25 +2740,20 @@ def recursive_get(config_to_search, config_elements):
 
     Note
     ----
-        This is actually just a wrapper around the function
-        ``actually_recursive_get``, which is needed to pop off standalone model
-        configurations.
+        The levels are walked in a loop; ``config_elements`` is not
+        modified. To look up many variables in the same config, see
+        ``ConfigPathIndex``.
     """
     logging.debug("Incoming config elements: %s", config_elements)
-    my_config_elements = copy.deepcopy(config_elements)
-    this_config = my_config_elements.pop(0)
-
-    logger.debug("this_config=%s", this_config)
-    logger.debug("config_to_search=%s", config_to_search)
-    try:
-        result = config_to_search[this_config]
-    except:
-        raise ValueError(
-            "Exactly None! Couldn't find an answer for:", my_config_elements
-        )
-    # This looks dangerous too...
-    if my_config_elements:
-        return recursive_get(result, my_config_elements)
+    result = config_to_search
+    for position, this_config in enumerate(config_elements):
+        try:
+            result = result[this_config]
+        except Exception:
+            raise ValueError(
+                "Exactly None! Couldn't find an answer for:",
+                list(config_elements[position + 1 :]),
+            )
 
     # Unicode vs Str again
     if six.PY2:
@@ -1271,83 +2769,380 @@ def recursive_get(config_to_search, config_elements):
     return result
 
 
+class RegexListMatcher(object):
+    """
+    Checks strings against a list of regular expressions at once.
+
+    The expressions are joined into a single alternation, so that a string
+    is matched once instead of once per expression. The results for the
+    last ``max_size`` strings are remembered.
+
+    Expressions that can not be joined (with different flags, or with
+    backreferences, whose group numbers would change) are matched one by
+    one, as before.
+
+    Parameters
+    ----------
+    regex_list : list
+        Compiled regular expressions
+    max_size : int
+        How many results to remember
+    """
+
+    def __init__(self, regex_list, max_size=REGEX_MATCH_CACHE_SIZE):
+        self.regex_list = list(regex_list)
+        self.max_size = max_size
+        self._results = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._combined = None
+        flags = set(regex.flags for regex in self.regex_list)
+        backreference = re.compile(r"\\[0-9]|\(\?P=")
+        if len(flags) == 1 and not any(
+            backreference.search(regex.pattern) for regex in self.regex_list
+        ):
+            try:
+                self._combined = re.compile(
+                    "|".join("(?:%s)" % regex.pattern for regex in self.regex_list),
+                    flags.pop(),
+                )
+            except re.error:
+                pass
+
+    def _match(self, test_str):
+        if self._combined is not None:
+            return self._combined.match(test_str) is not None
+        return any(regex.match(test_str) for regex in self.regex_list)
+
+    def match(self, test_str):
+        """Checks if any of the expressions matches the start of ``test_str``"""
+        with self._lock:
+            if test_str in self._results:
+                result = self._results.pop(test_str)
+                self._results[test_str] = result
+                count("regex list match cache hits")
+                return result
+        result = self._match(test_str)
+        count("regex list match cache misses")
+        with self._lock:
+            self._results[test_str] = result
+            while len(self._results) > self.max_size:
+                self._results.popitem(last=False)
+        return result
+
+
+# One RegexListMatcher per list of regular expressions:
+_regex_list_matchers = {}
+
+
 def determine_regex_list_match(test_str, regex_list):
-    result = []
-    for regex in regex_list:
-        logging.debug("Checking %s against %s", test_str, regex)
-        result.append(regex.match(test_str))
-    logging.debug("Will return %s" % any(result))
-    return any(result)
+    """
+    Checks if any of the regular expressions in ``regex_list`` matches the
+    start of ``test_str``, using a ``RegexListMatcher`` for the list.
+
+    Returns
+    -------
+    bool
+    """
+    if not regex_list:
+        return False
+    key = tuple(regex_list)
+    matcher = _regex_list_matchers.get(key)
+    if matcher is None:
+        matcher = _regex_list_matchers.setdefault(key, RegexListMatcher(regex_list))
+    return matcher.match(test_str)
+
+
+class Template(object):
+    """
+    A string with variables (``${...}``), compiled for repeated rendering.
+
+    The string is split once into the literal parts and the variables
+    between them, in the order ``find_variable`` replaces them. A variable
+    is the whole part between ``${`` and the next ``}``, including ``!``
+    attributes of dates (e.g. ``start_date!syear``); they are applied, and
+    remembered, with the value of the variable (see ``render_variable``).
+    Math (``$((...))``) is left in the literal parts; it is only done once
+    all variables in it are replaced (see ``do_math_in_entry``).
+
+    Parameters
+    ----------
+    raw_str : str
+    """
+
+    def __init__(self, raw_str):
+        self.raw_str = raw_str
+        # (start of "${", variable, end of "}") of every variable:
+        self.variables = []
+        # A "${" without a "}" after the last variable:
+        self.unterminated = False
+        end = 0
+        start = raw_str.find("${")
+        while start != -1:
+            close = raw_str.find("}", start + 2)
+            if close == -1:
+                self.unterminated = True
+                break
+            end = close + 1
+            self.variables.append((start, raw_str[start + 2 : close], end))
+            start = raw_str.find("${", end)
+        # (tuple(white_or_black_list), isblacklist) -> see replaceable:
+        self._replaceable = {}
+
+    def replaceable(self, white_or_black_list, isblacklist):
+        """
+        Returns how many of the variables are replaced: all up to the first
+        one which must not be (see ``white_or_black_list`` and
+        ``constant_blacklist``).
+        """
+        key = (tuple(white_or_black_list), isblacklist)
+        number = self._replaceable.get(key)
+        if number is None:
+            number = 0
+            for _, var, _ in self.variables:
+                if (
+                    determine_regex_list_match(var, white_or_black_list)
+                    == isblacklist
+                ) or determine_regex_list_match(var, constant_blacklist):
+                    break
+                number += 1
+            self._replaceable[key] = number
+        return number
+
+
+# Compiled templates, by string (see compile_template):
+_templates = {}
+
+
+def compile_template(raw_str):
+    """
+    Returns the ``Template`` of ``raw_str``, compiled only the first time a
+    string is seen.
+    """
+    template = _templates.get(raw_str)
+    if template is not None:
+        count("template cache hits")
+        return template
+    count("template cache misses")
+    if len(_templates) >= TEMPLATE_CACHE_SIZE:
+        _templates.clear()
+    template = _templates[raw_str] = Template(raw_str)
+    return template
+
+
+def find_variable(
+    tree, rhs, full_config, white_or_black_list, isblacklist, index=None, memo=None
+):
+    """
+    Replaces the variables (``${...}``) in ``rhs``.
 
+    The variables are replaced from left to right, in a single pass over the
+    compiled ``Template`` of the string, and always turned into strings --
+    unless one of them is a list, which is then returned instead. Replacing
+    stops at the first variable which must not be replaced. If a value
+    brings in new variables, the rest of the string is scanned again.
 
-def find_variable(tree, rhs, full_config, white_or_black_list, isblacklist):
-    raw_str = rhs
+    Parameters
+    ----------
+    tree : list
+        Where the entry is; variables are looked up in its chapter first
+    rhs
+        The entry; anything but a string is returned as it is
+    full_config : dict
+    white_or_black_list : list
+    isblacklist : bool
+    index : ConfigPathIndex, optional
+    memo : dict, optional
+        Values of the variables already looked up in the same pass, by
+        chapter and variable
+
+    Raises
+    ------
+    ValueError
+        If a variable can not be found, or a ``${`` is not closed.
+    """
     if not tree[-1]:
         tree = tree[:-1]
-    if isinstance(raw_str, str) and "${" in raw_str:
-        ok_part, rest = raw_str.split("${", 1)
-        var, new_raw = rest.split("}", 1)
-        if ((determine_regex_list_match(var, white_or_black_list)) != isblacklist) and (
-            not determine_regex_list_match(var, constant_blacklist)
-        ):
-            var_result, var_attrs = actually_find_variable(tree, var, full_config)
-
-            if type(var_result) == str:
-                if "${" in var_result:
-                    var_result = find_variable(
-                        tree,
-                        var_result,
-                        full_config,
-                        white_or_black_list,
-                        isblacklist,
-                    )
+    if not isinstance(rhs, str) or "${" not in rhs:
+        return rhs
+    template = compile_template(rhs)
+    replaceable = template.replaceable(white_or_black_list, isblacklist)
+    rendered = ""
+    end = 0
+    for start, var, next_end in template.variables[:replaceable]:
+        # Variables are looked up in the chapter of the entry first:
+        memo_key = (tree[0] if tree else None, var)
+        if memo is not None and memo_key in memo:
+            count("variable memo hits")
+            var_result = memo[memo_key]
+        else:
+            var_result = render_variable(
+                tree, var, full_config, white_or_black_list, isblacklist, index, memo
+            )
+            if memo is not None:
+                count("variable memo misses")
+                memo[memo_key] = var_result
+
+        # BUG/FIXME: Note that this means that we **always** will get
+        # back a string if a variable is replaced!
+        if type(var_result) in [list]:
+            return var_result
+        rendered += rhs[end:start] + str(var_result)
+        end = next_end
+        if "${" in rendered or (rendered[-1:] == "$" and rhs[end : end + 1] == "{"):
+            # The value brought in a new variable:
+            return find_variable(
+                tree,
+                rendered + rhs[end:],
+                full_config,
+                white_or_black_list,
+                isblacklist,
+                index,
+                memo,
+            )
+    if replaceable == len(template.variables) and template.unterminated:
+        raise ValueError("Missing } after ${ in %s" % rhs)
+    return rendered + rhs[end:]
 
-                if "$((" in var_result:
-                    var_result= do_math_in_entry(tree, var_result, full_config)
 
-            if var_attrs:
-                rentry = []
-                if not isinstance(var_result, Date):
-                    var_result = var_result.replace(DATE_MARKER, "")
-                    entry = Date(var_result)
-                else:
-                    entry = var_result
-                for attr in var_attrs.split("!"):
-                    rentry.append(str(getattr(entry, attr)))
-                var_result = "".join(rentry)
+def render_variable(
+    tree, var, full_config, white_or_black_list, isblacklist, index=None, memo=None
+):
+    """
+    Returns what ``find_variable`` puts in place of ``${var}`` in an entry at
+    ``tree``.
 
+    The value of the variable is looked up (see ``actually_find_variable``),
+    variables and math in it are resolved, and the ``!`` attributes of dates
+    (e.g. ``${start_date!syear}``) are applied.
 
-            # if var_result:
-            # BUG/FIXME: Note that this means that we **always** will get
-            # back a string if a variable is replaced!
-            if type(var_result) not in [list]:
-                ok_part, var_result, more_rest = (
-                    str(ok_part),
-                    str(var_result),
-                    str(new_raw),
-                )
+    Parameters
+    ----------
+    tree : list
+        Where the entry is; only the chapter, ``tree[0]``, matters
+    var : str
+        The name of the variable, without ``${`` and ``}``
+    full_config : dict
+    white_or_black_list : list
+    isblacklist : bool
+    index : ConfigPathIndex, optional
+    memo : dict, optional
+        Results of earlier calls in the same pass, see ``find_variable``
 
-                if "${" in ok_part + var_result + more_rest:
-                    raw_str = find_variable(
-                        tree,
-                        ok_part + var_result + more_rest,
-                        full_config,
-                        white_or_black_list,
-                        isblacklist,
-                    )
-                else:
-                    raw_str = ok_part + var_result + more_rest
+    Returns
+    -------
+    The value of the variable
+    """
+    var_result, var_attrs = actually_find_variable(tree, var, full_config, index)
+
+    if type(var_result) == str:
+        if "${" in var_result:
+            var_result = find_variable(
+                tree,
+                var_result,
+                full_config,
+                white_or_black_list,
+                isblacklist,
+                index,
+                memo,
+            )
 
-            else:
-                return var_result
-    return raw_str
+        if "$((" in var_result:
+            var_result = do_math_in_entry(tree, var_result, full_config)
+
+    if var_attrs:
+        rentry = []
+        if not isinstance(var_result, Date):
+            var_result = var_result.replace(DATE_MARKER, "")
+            entry = Date(var_result)
+        else:
+            entry = var_result
+        for attr in var_attrs.split("!"):
+            rentry.append(str(getattr(entry, attr)))
+        var_result = "".join(rentry)
+    return var_result
+
+
+class ConfigPathIndex(object):
+    """
+    A flat index of all entries of a nested config, by path.
 
+    Every entry of every (nested) mapping is indexed under its path, the
+    tuple of keys leading to it, e.g. ``("computer", "pool_directories",
+    "pool")`` for ``computer.pool_directories.pool``. Looking up a dotted
+    variable is then a single dictionary lookup, instead of a walk down the
+    config, one level at a time.
+
+    The index keeps the mapping and key of each entry, not its value, so
+    changed values are always seen. Mappings put into the config later on
+    must be announced with ``add``, and renamed keys with ``replace``. Like
+    ``recursive_get``, the index does not look into lists.
+
+    Parameters
+    ----------
+    config : dict
+        The config to index
+    """
 
-def actually_find_variable(tree, rhs, full_config):
+    def __init__(self, config):
+        self._entries = {}
+        self.add((), config)
+
+    def add(self, path, mapping):
+        """Indexes ``mapping``, found at ``path``, and all mappings in it"""
+        stack = [(tuple(path), mapping)]
+        while stack:
+            path, mapping = stack.pop()
+            for key in list(mapping):
+                self._entries[path + (key,)] = (mapping, key)
+                value = mapping[key]
+                if isinstance(value, Mapping):
+                    stack.append((path + (key,), value))
+
+    def discard(self, path):
+        """Removes the entry at ``path``, and all entries in it"""
+        location = self._entries.pop(tuple(path), None)
+        if location is None:
+            return
+        mapping, key = location
+        stack = [(tuple(path), mapping.get(key))]
+        while stack:
+            path, value = stack.pop()
+            if isinstance(value, Mapping):
+                for key in value:
+                    self._entries.pop(path + (key,), None)
+                    stack.append((path + (key,), value[key]))
+
+    def replace(self, path, entries):
+        """
+        Replaces the entry at ``path`` by ``entries``, a mapping of new keys
+        to values in the same mapping -- before the mapping itself is
+        changed, as ``recursive_run_function`` does after a ``func``
+        returns.
+        """
+        path = tuple(path)
+        location = self._entries.get(path)
+        if location is None:
+            return
+        mapping, _ = location
+        self.discard(path)
+        for key, value in six.iteritems(entries):
+            # A key taken over is replaced, with all entries in it:
+            self.discard(path[:-1] + (key,))
+            self._entries[path[:-1] + (key,)] = (mapping, key)
+            if isinstance(value, Mapping):
+                self.add(path[:-1] + (key,), value)
+
+    def lookup(self, config_elements):
+        """
+        Returns the mapping and key of the entry at ``config_elements``, or
+        ``None`` if there is none.
+        """
+        return self._entries.get(tuple(config_elements))
+
+
+def actually_find_variable(tree, rhs, full_config, index=None):
     config_elements = rhs.split(".")
-    valid_names = list(full_config)
-    logging.debug(valid_names)
-    if config_elements[0] not in valid_names:
+    if config_elements[0] not in full_config:
         config_elements.insert(0, tree[0])
 
     full_varname = config_elements[-1]
@@ -1357,7 +3152,15 @@ def actually_find_variable(tree, rhs, full_config):
         var_name, var_attr = full_varname, None
 
     config_elements[-1] = var_name
-    original_config_elements = copy.deepcopy(config_elements)
+    if index is not None:
+        location = index.lookup(config_elements) or index.lookup(
+            ["general"] + config_elements[1:]
+        )
+        if location is None:
+            raise ValueError("Sorry: %s not found" % (rhs))
+        mapping, key = location
+        return mapping[key], var_attr
+    original_config_elements = list(config_elements)
     try:
         var_result = recursive_get(full_config, config_elements)
         # return var_result
@@ -1375,7 +3178,238 @@ def actually_find_variable(tree, rhs, full_config):
     return var_result, var_attr
 
 
-def list_to_multikey(tree, rhs, config_to_search, ignore_list, isblacklist):
+def _atomic_entries(config):
+    # Lists (path, tree, container, key) of all entries recursive_run_function
+    # would run an "atomic" function on, in the same order. The tree has None
+    # for list items, like the one recursive_run_function passes on:
+    atomic_types = (str, int, float, Date)
+    if six.PY2:  # pragma: no cover
+        atomic_types += (unicode,)
+    entries = []
+    stack = [((), [], config)]
+    while stack:
+        path, tree, mapping = stack.pop()
+        if isinstance(mapping, list):
+            keys, key_trees = range(len(mapping)), [None] * len(mapping)
+        else:
+            keys = list(mapping)
+            key_trees = keys
+        children = []
+        for key, key_tree in zip(keys, key_trees):
+            value = mapping[key]
+            if type(value) in atomic_types:
+                entries.append((path + (key,), tree + [key_tree], mapping, key))
+            elif isinstance(value, (dict, list)):
+                children.append((path + (key,), tree + [key_tree], value))
+        stack.extend(reversed(children))
+    return entries
+
+
+def variable_references(raw_str, white_or_black_list, isblacklist):
+    """
+    Lists the variables a string refers to, in the order ``find_variable``
+    replaces them.
+
+    Like in ``find_variable``, a variable which must not be replaced (see
+    ``white_or_black_list`` and ``constant_blacklist``) ends the list.
+
+    Returns
+    -------
+    list
+        The variable names (the parts between ``${`` and ``}``)
+    """
+    template = compile_template(raw_str)
+    replaceable = template.replaceable(white_or_black_list, isblacklist)
+    return [var for _, var, _ in template.variables[:replaceable]]
+
+
+def variable_path(tree, var, full_config, index=None):
+    """
+    Returns the path of the entry a variable refers to, the same way
+    ``actually_find_variable`` looks it up, or ``None`` if it does not
+    exist. ``index`` is a ``ConfigPathIndex`` of ``full_config``, built if
+    not given.
+    """
+    if index is None:
+        index = ConfigPathIndex(full_config)
+    config_elements = var.split(".")
+    if config_elements[0] not in full_config:
+        config_elements.insert(0, tree[0])
+    config_elements[-1] = config_elements[-1].split("!", 1)[0]
+    for candidate in (config_elements, ["general"] + config_elements[1:]):
+        if index.lookup(candidate):
+            return tuple(candidate)
+    return None
+
+
+def resolve_variables(config, white_or_black_list, isblacklist=True, index=None):
+    """
+    Replaces all variables (``${...}``) in the values of ``config``.
+
+    This replaces running ``find_variable`` on all atomic entries with
+    ``recursive_run_function``, but replaces every entry only once: all
+    entries referring to variables are put in a graph of which entries they
+    refer to (their fully qualified path, with the fallback to ``general`` of
+    ``actually_find_variable``), and each is resolved after all entries it
+    refers to. Values that are taken over thus never contain variables any
+    more, and are not resolved again for every entry using them.
+
+    Notes
+    -----
+    The result is the same as before, also for variables used before the
+    entry they refer to is set, or which are overridden in a chapter, with
+    two intended exceptions, where the old result depended on the order of
+    the chapters:
+
+    * A value taken over from another chapter, like ``${echam.dir}``, has
+      its own variables replaced in that chapter. Before, if that chapter
+      came later, they were looked up in the chapter using the value, and
+      an error was raised if they were not found there.
+    * Entries referring to themselves, directly or in a cycle, raise a
+      ``KeyError`` naming all cycles, instead of a ``RecursionError``.
+
+    Parameters
+    ----------
+    config : dict
+        The complete configuration, modified **in place**
+    white_or_black_list : list
+        Regular expressions of variables to replace, or not to replace
+    isblacklist : bool
+        Whether ``white_or_black_list`` is a black list
+    index : ConfigPathIndex, optional
+        An index of ``config``, built if not given
+
+    Raises
+    ------
+    KeyError
+        If entries refer to themselves, or to each other in cycles. All
+        cycles are reported at once, before anything is replaced.
+    ValueError
+        If a variable can not be found, like ``actually_find_variable``.
+    """
+    if index is None:
+        index = ConfigPathIndex(config)
+    # Within this pass, every variable of a chapter has the same value:
+    memo = {}
+    entries = {}
+    order = []
+    for path, tree, container, key in _atomic_entries(config):
+        value = container[key]
+        if isinstance(value, str) and "${" in value:
+            entries[path] = (tree, container, key)
+            order.append(path)
+    edges = {}
+    for path in order:
+        tree, container, key = entries[path]
+        edges[path] = dependencies = []
+        for var in variable_references(
+            container[key], white_or_black_list, isblacklist
+        ):
+            target = variable_path(tree, var, config, index)
+            if target is None:
+                # Reported by find_variable, once the entry is resolved
+                continue
+            if target in entries:
+                candidates = [target]
+            else:
+                # The variable might be a whole chapter or list:
+                candidates = [
+                    other for other in order if other[: len(target)] == target
+                ]
+            for candidate in candidates:
+                if candidate not in dependencies:
+                    dependencies.append(candidate)
+    cycles = find_cycles(order, edges)
+    if cycles:
+        raise KeyError(
+            "Opps cyclic dependency between variables: %s"
+            % "; ".join(
+                " -> ".join(".".join(str(key) for key in path) for path in cycle)
+                for cycle in cycles
+            )
+        )
+    resolved = set()
+    for root in order:
+        if root in resolved:
+            continue
+        # Depth first, resolving each entry after all it depends on:
+        work = [(root, iter(edges[root]))]
+        resolved.add(root)
+        while work:
+            path, dependencies = work[-1]
+            for dependency in dependencies:
+                if dependency not in resolved:
+                    resolved.add(dependency)
+                    work.append((dependency, iter(edges[dependency])))
+                    break
+            else:
+                work.pop()
+                tree, container, key = entries[path]
+                container[key] = find_variable(
+                    tree,
+                    container[key],
+                    config,
+                    white_or_black_list,
+                    isblacklist,
+                    index,
+                    memo,
+                )
+                count("variables resolved")
+    return config
+
+
+def resolve_variables_in_keys(
+    config, white_or_black_list, isblacklist=True, index=None
+):
+    """
+    Replaces all variables (``${...}``) in the keys of ``config``.
+
+    Variables are looked up once per chapter, like in ``resolve_variables``.
+    Renaming a key may change what a variable refers to, so the looked up
+    values are forgotten whenever a key is renamed.
+
+    Parameters
+    ----------
+    config : dict
+        The complete configuration, modified **in place**
+    white_or_black_list : list
+    isblacklist : bool
+    index : ConfigPathIndex, optional
+        An index of ``config``, built if not given, and kept up to date with
+        the renamed keys
+    """
+    if index is None:
+        index = ConfigPathIndex(config)
+    memo = {}
+
+    def find_variable_in_key(tree, key, *args, **kwargs):
+        new_key = find_variable(tree, key, *args, **kwargs)
+        if new_key != key:
+            memo.clear()
+            if None not in tree:
+                location = index.lookup(tree)
+                if location is not None:
+                    mapping, _ = location
+                    index.replace(tree, {new_key: mapping[key]})
+        return new_key
+
+    recursive_run_function(
+        [],
+        config,
+        "keys",
+        find_variable_in_key,
+        config,
+        white_or_black_list,
+        isblacklist=isblacklist,
+        index=index,
+        memo=memo,
+    )
+    return config
+
+
+def list_to_multikey(
+    tree, rhs, config_to_search, ignore_list, isblacklist, index=None
+):
     """
     A recursive_run_function conforming func which puts any list based key to a
     multikey elsewhere. Sorry, that sounds confusing even to me, and I wrote
@@ -1389,7 +3423,9 @@ def list_to_multikey(tree, rhs, config_to_search, ignore_list, isblacklist):
 
     config_to_search : dict
 
-
+    index : ConfigPathIndex, optional
+        An index of ``config_to_search``. The keys a list based key is
+        replaced by are put into it.
 
     """
     list_fence = "[["
@@ -1409,7 +3445,7 @@ def list_to_multikey(tree, rhs, config_to_search, ignore_list, isblacklist):
                 #    return {lhs: rhs}
                 key_elements = key_in_list.split(".")
                 entries_of_key, _ = actually_find_variable(
-                    tree, key_in_list, config_to_search
+                    tree, key_in_list, config_to_search, index
                 )
 
                 if isinstance(entries_of_key, str):
@@ -1453,6 +3489,8 @@ def list_to_multikey(tree, rhs, config_to_search, ignore_list, isblacklist):
                         )
                 else:
                     return_dict = return_dict2
+                if index is not None:
+                    index.replace(tree, return_dict)
                 return return_dict
             return {lhs: rhs}
         if isinstance(rhs, str) and list_fence in rhs:
@@ -1461,7 +3499,9 @@ def list_to_multikey(tree, rhs, config_to_search, ignore_list, isblacklist):
             actual_list, new_raw = rest.split(list_end, 1)
             key_in_list, value_in_list = actual_list.split("-->", 1)
             key_elements = key_in_list.split(".")
-            entries_of_key, _ = actually_find_variable(tree, key_in_list, config_to_search)
+            entries_of_key, _ = actually_find_variable(
+                tree, key_in_list, config_to_search, index
+            )
             if isinstance(entries_of_key, str):
                 entries_of_key = [entries_of_key]
             for entry in entries_of_key:
@@ -1487,6 +3527,58 @@ def list_to_multikey(tree, rhs, config_to_search, ignore_list, isblacklist):
     return rhs
 
 
+def resolve_machine_config(machine_file=None):
+    """
+    Reads a machine file and resolves its ``choose_`` blocks and variables.
+
+    This is what ``esm_environment.environment_infos`` needs of the machine
+    file. The result is computed only once per process, and kept in the
+    ``MACHINE_CONFIG_CACHE`` for as long as neither the content of the file
+    nor the hostname (which the choices may depend on) changes.
+
+    Parameters
+    ----------
+    machine_file : str, optional
+        The machine file; by default the one of this computer (see
+        ``determine_computer_from_hostname``).
+
+    Returns
+    -------
+    dict
+        A copy of the resolved machine config, which may be modified in
+        place.
+    """
+    machine_file = machine_file or determine_computer_from_hostname()
+    path = CONFIG_FILE_INDEX.find(machine_file, YAML_AUTO_EXTENSIONS)
+    if not path:
+        raise FileNotFoundError(
+            "All file extensions tried and none worked for %s" % machine_file
+        )
+    path = os.path.abspath(path)
+    with open(path) as machine_config_file:
+        fingerprint = (
+            MACHINE_CONFIG_CACHE_VERSION,
+            esm_cache.content_hash(machine_config_file.read()),
+        )
+    cache_key = (path, socket.gethostname())
+    cached = _machine_configs.get(cache_key)
+    if cached and cached[0] == fingerprint:
+        count("machine config cache hits")
+        return copy_document(cached[1])
+    cache_name = "%s@%s" % cache_key
+    config = MACHINE_CONFIG_CACHE.get(cache_name, fingerprint)
+    if config is None:
+        count("machine config cache misses")
+        config = yaml_file_to_dict(path)
+        basic_choose_blocks(config, config)
+        resolve_variables(config, [], True)
+        MACHINE_CONFIG_CACHE.put(cache_name, fingerprint, config)
+    else:
+        count("machine config cache hits")
+    _machine_configs[cache_key] = (fingerprint, config)
+    return copy_document(config)
+
+
 def determine_computer_from_hostname():
     """
     Determines which yaml config file is needed for this computer
@@ -1702,30 +3794,76 @@ def convert(value):
 
 
 def list_all_keys_with_priority_marker(config):
+    """
+    Lists the keys marked with the ``priority_marker``, at all levels of ``config``.
+
+    Parameters
+    ----------
+    config : dict
+
+    Returns
+    -------
+    list
+        All marked keys, in the order they are found.
+    """
     all_keys = []
-    for key in list(config):
-        if isinstance(key, str):
-            if priority_marker in key:
+    stack = [config]
+    while stack:
+        mapping = stack.pop()
+        for key, value in six.iteritems(mapping):
+            if isinstance(key, str) and priority_marker in key:
                 all_keys.append(key)
-            if isinstance(config[key], dict):
-                list_all_keys_with_priority_marker(config[key])
-    logging.critical(all_keys)
+            if isinstance(value, dict):
+                stack.append(value)
+    logging.debug(all_keys)
     return all_keys
 
 
 def finish_priority_merge(config):
-    all_keys = list(config)
-    all_keys_with_priority_marker = list_all_keys_with_priority_marker(config)
-    while all_keys_with_priority_marker:
-        for key in all_keys:
-            value = config[key]
+    """
+    Removes the ``priority_marker`` from all keys of ``config``, at all levels.
+
+    A marked key replaces the unmarked key of the same name, if there is one.
+    Every dictionary in ``config`` is visited exactly once.
+
+    Parameters
+    ----------
+    config : dict
+        The configuration, which is modified **in place**
+
+    Returns
+    -------
+    int
+        The number of keys that were renamed
+    """
+    renamed = 0
+    stack = [config]
+    while stack:
+        mapping = stack.pop()
+        for key in list(mapping):
+            value = mapping[key]
+            if isinstance(key, str) and priority_marker in key:
+                del mapping[key]
+                mapping[key.replace(priority_marker, "")] = value
+                renamed += 1
             if isinstance(value, dict):
-                return finish_priority_merge(config)
-            if priority_marker in key:
-                del config[key]
-                config[key.replace(priority_marker, "")] = value
-        # Recreate the test list
-        all_keys_with_priority_marker = list_all_keys_with_priority_marker(config)
+                stack.append(value)
+    return renamed
+
+
+def _file_stats(paths):
+    file_stats = []
+    for path in paths:
+        stat = os.stat(path)
+        file_stats.append((path, stat.st_mtime, stat.st_size))
+    return file_stats
+
+
+def _file_stats_match(file_stats):
+    try:
+        return _file_stats([entry[0] for entry in file_stats]) == file_stats
+    except (IOError, OSError):
+        return False
 
 
 class GeneralConfig(dict):  # pragma: no cover
@@ -1738,14 +3876,23 @@ class GeneralConfig(dict):  # pragma: no cover
             config_path = path
         else:
             config_path = FUNCTION_PATH + "/" + path + "/" + path
-        self.config = yaml_file_to_dict(config_path)
-        for attachment in CONFIGS_TO_ALWAYS_ATTACH_AND_REMOVE:
-            attach_to_config_and_remove(self.config, attachment)
+        del CONFIG_FILES_READ[:]
+        self.config_path = config_path
         self._config_init(user_config)
         for k, v in six.iteritems(self.config):
             self.__setitem__(k, v)
         del self.config
 
+    def _read_config(self):
+        """
+        Returns the contents of the file at ``config_path``, with the files it
+        refers to (``CONFIGS_TO_ALWAYS_ATTACH_AND_REMOVE``) attached.
+        """
+        config = yaml_file_to_dict(self.config_path)
+        for attachment in CONFIGS_TO_ALWAYS_ATTACH_AND_REMOVE:
+            attach_to_config_and_remove(config, attachment)
+        return config
+
     def _config_init(self, user_config):
         raise NotImplementedError(
             "Subclasses of GeneralConfig must define a _config_init!"
@@ -1757,12 +3904,81 @@ class ConfigSetup(GeneralConfig):  # pragma: no cover
 
     def _config_init(self, user_config):
         # user_config should be ok already
-        # self.config contains first yaml file and further_readings
 
+        setup_config, model_config = self._setup_and_model_configs()
+
+        if not setup_config["general"]["standalone"]:
+            # that should happen in Shell2Yaml
+            if user_config["general"]["setup_name"] in user_config:
+                user_config["general"].update(
+                    user_config[user_config["general"]["setup_name"]]
+                )
+                del user_config[user_config["general"]["setup_name"]]
+
+        # merge everything    
+
+        logging.debug("Valid Setup Names = %s", setup_config["general"]["valid_setup_names"])
+        logging.debug("Valid Model Names = %s", setup_config["general"]["valid_model_names"])
+
+        self._blackdict = blackdict = priority_merge_dicts(
+            user_config, setup_config, priority="first"
+        )
+        self.config = priority_merge_dicts(blackdict, model_config, priority="first")
+        #pprint_config(self.config)
+        #sys.exit(0)
+
+    def _setup_and_model_configs(self):
+        """
+        Returns the setup and model configs, with all included files attached.
+
+        Neither of them depends on the user config, so between two chunks of
+        an experiment they only change if one of the files they are read from
+        changes. They are therefore kept in the ``MERGED_CONFIG_CACHE``,
+        together with the list of those files and their modification times
+        and sizes. As long as these still match, the setup file is not even
+        read, and nothing is attached.
+        """
+        machine_file = determine_computer_from_hostname()
+        cache_name = repr(
+            (
+                os.path.abspath(self.config_path),
+                machine_file,
+                esm_master_dir,
+                CONFIG_INCLUDE_DIRS,
+            )
+        )
+        cached = MERGED_CONFIG_CACHE.get(cache_name, MERGED_CONFIG_CACHE_VERSION)
+        if cached:
+            file_stats, setup_config, model_config = cached
+            if _file_stats_match(file_stats):
+                count("merged config cache hits")
+                CONFIG_FILES_READ.extend(entry[0] for entry in file_stats)
+                return setup_config, model_config
+        count("merged config cache misses")
+        # The first yaml file, with its further_readings:
+        self.config = self._read_config()
+        setup_config, model_config = self._attach_setup_and_model_configs(machine_file)
+        del self.config
+        if MERGED_CONFIG_CACHE.enabled:
+            file_stats = _file_stats(sorted(set(CONFIG_FILES_READ)))
+            MERGED_CONFIG_CACHE.put(
+                cache_name,
+                MERGED_CONFIG_CACHE_VERSION,
+                (file_stats, setup_config, model_config),
+            )
+        return setup_config, model_config
+
+    def _attach_setup_and_model_configs(self, machine_file):
         # setup_config:
 
+        # Load the machine file and all included configs at once; they are
+        # attached one after the other below:
+        prefetch_config_files(
+            [CONFIG_FILE_INDEX.find(machine_file)] + list_included_files(self.config)
+        )
+
         setup_config = {
-            "computer": yaml_file_to_dict(determine_computer_from_hostname()),
+            "computer": yaml_file_to_dict(machine_file),
             "general": {},
         }
         for attachment in CONFIGS_TO_ALWAYS_ATTACH_AND_REMOVE:
@@ -1780,20 +3996,11 @@ class ConfigSetup(GeneralConfig):  # pragma: no cover
                 setup_config["general"]["include_models"] = self.config["general"][
                     "include_models"
                 ]
-        
-                # that should happen in Shell2Yaml
-                if user_config["general"]["setup_name"] in user_config:
-                    user_config["general"].update(
-                        user_config[user_config["general"]["setup_name"]]
-                    )
-                    del user_config[user_config["general"]["setup_name"]]
                 dict_merge(setup_config, self.config)
 
 
-                setup_config["general"]["valid_setup_names"] = valid_setup_names = list(
-                    setup_config
-                )
-                setup_config["general"]["valid_model_names"] = valid_model_names = []
+                setup_config["general"]["valid_setup_names"] = list(setup_config)
+                setup_config["general"]["valid_model_names"] = []
         else:
             setup_config["general"].update({"standalone": True})
             setup_config["general"].update({"models": [self.config["model"]]})
@@ -1804,13 +4011,9 @@ class ConfigSetup(GeneralConfig):  # pragma: no cover
             ]
             setup_config[self.config["model"]]=self.config
 
-            setup_config["general"]["valid_setup_names"] = valid_setup_names = list(
-                setup_config
-            )
+            setup_config["general"]["valid_setup_names"] = list(setup_config)
             setup_config["general"]["valid_setup_names"].remove(self.config["model"])
-            setup_config["general"]["valid_model_names"] = valid_model_names = [self.config["model"]]
-
-        del self.config
+            setup_config["general"]["valid_model_names"] = [self.config["model"]]
 
         setup_config["general"].update(
             {"esm_master_dir": esm_master_dir, "expid": "test"}
@@ -1838,19 +4041,7 @@ class ConfigSetup(GeneralConfig):  # pragma: no cover
             #valid_model_names.append(list(model_config)) happens automatically
 
         # model_config should be ok now
-        # merge everything    
-
-        logging.debug("Valid Setup Names = %s", valid_setup_names)
-        logging.debug("Valid Model Names = %s", valid_model_names)
-
-        self._blackdict = blackdict = priority_merge_dicts(
-            user_config, setup_config, priority="first"
-        )
-        self.config = priority_merge_dicts(blackdict, model_config, priority="first")
-        #pprint_config(self.config)
-        #sys.exit(0)
-
-
+        return setup_config, model_config
 
     def calendar(self):
 
@@ -1905,74 +4096,17 @@ class ConfigSetup(GeneralConfig):  # pragma: no cover
         del self._blackdict
 
     def choose_blocks(self, config, blackdict={}, isblacklist=True):
-        all_set_variables = {}
-
-        all_names = list(config)
-        while True:
-            for name in all_names:
-                all_set_variables[name] = {}
-                name_chooses = list_all_keys_starting_with_choose(
-                    config[name], name, gray_list, isblacklist
-                )
-                if name_chooses == []:
-                    continue
-                for key, block in name_chooses:
-                    all_set_variables[name][
-                        key
-                    ] = determine_set_variables_in_choose_block(block, all_names, name)
-
-                task_list = model_with_choose, choose_key = find_one_independent_choose(
-                    all_set_variables
-                )
-
-            for key in list(all_set_variables):
-                if not all_set_variables[key]:
-                    del all_set_variables[key]
-            if not all_set_variables:
-                break
-            if "jsbach.scenario" in choose_key:
-                pass
-                # pdb.set_trace()
-            logging.debug("The task list is: %s", task_list)
-            logging.debug("all_set_variables: %s", all_set_variables)
-            if model_with_choose in list(blackdict):
-                resolve_basic_choose(
-                    config,
-                    config[model_with_choose],
-                    choose_key,
-                    blackdict[model_with_choose],
-                )
-            else:
-                resolve_basic_choose(config, config[model_with_choose], choose_key, {})
-            del all_set_variables[model_with_choose][choose_key]
-            logging.debug("Remaining all_set_variables=%s", all_set_variables)
-
-        add_entries_to_chapter_in_config(config, all_names, config, all_names)
-        remove_entries_from_chapter_in_config(config, all_names, config, all_names)
+        resolve_choose_blocks(config, blackdict, isblacklist, choose_memo(config))
 
     def run_recursive_functions(self, config, isblacklist=True):
         logging.debug("Top of run recursive functions")
         recursive_run_function([], config, "atomic", mark_dates, config)
         #pprint_config(config)
         #sys.exit(1)
-        recursive_run_function(
-            [],
-            config,
-            "atomic",
-            find_variable,
-            config,
-            gray_list,
-            isblacklist=isblacklist,
-        )
-        recursive_run_function(
-            [],
-            config,
-            "keys",
-            find_variable,
-            config,
-            gray_list,
-            isblacklist=isblacklist,
-        )
+        # One index for all passes; those renaming keys keep it up to date:
+        index = ConfigPathIndex(config)
+        resolve_variables(config, gray_list, isblacklist, index)
+        resolve_variables_in_keys(config, gray_list, isblacklist, index)
         recursive_run_function([], config, "atomic", do_math_in_entry, config)
         recursive_run_function([], config, "atomic", marked_date_to_date_object, config)
         recursive_run_function([], config, "atomic", unmark_dates, config)
@@ -1984,6 +4118,7 @@ class ConfigSetup(GeneralConfig):  # pragma: no cover
             config,
             gray_list,
             isblacklist=isblacklist,
+            index=index,
         )
         recursive_run_function([], config, "atomic", purify_booleans, config)
 
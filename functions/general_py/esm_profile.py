@@ -1,6 +1,9 @@
+import threading
 import time
 
 timing_info = []
+counters = {}
+_counter_lock = threading.Lock()
 
 def timing(f):
     def wrap(*args):
@@ -11,3 +14,22 @@ def timing(f):
         return ret
     return wrap
 
+def count(name, increment=1):
+    with _counter_lock:
+        counters[name] = counters.get(name, 0) + increment
+
+def counter_info():
+    info = {name: '{:s}: {}'.format(name, value) for name, value in counters.items()}
+    # Add the hit ratio of every cache or memo counting its hits or misses:
+    caches = set(
+        name.rsplit(" ", 1)[0]
+        for name in counters
+        if name.endswith(" hits") or name.endswith(" misses")
+    )
+    for cache in caches:
+        hits = counters.get(cache + " hits", 0)
+        lookups = hits + counters.get(cache + " misses", 0)
+        if lookups:
+            name = cache + " hit ratio"
+            info[name] = '{:s}: {:.1%}'.format(name, float(hits) / lookups)
+    return [info[name] for name in sorted(info)]
@@ -30,6 +30,8 @@ def date_representer(dumper, date):
 
 
 yaml.add_representer(Date, date_representer)
+if getattr(yaml, "__with_libyaml__", False):
+    yaml.add_representer(Date, date_representer, Dumper=yaml.CDumper)
 
 
 class SimulationSetup(object):
@@ -86,6 +88,8 @@ class SimulationSetup(object):
         if self.config["general"]["profile"]:
             for line in timing_info:
                 print(line)       
+            for line in counter_info():
+                print(line)
         sys.exit()
 
 
@@ -328,6 +332,8 @@ class SimulationSetup(object):
         environment = self.get_environment()
         commands = self.get_run_commands()
         tidy_call = "esm_tools/functions/general_py/esm_runscripts " + self.config["general"]["scriptname"] + " -e " + self.config["general"]["expid"] + " -t tidy_and_resubmit -p ${process}"
+        if self.config["general"].get("no_yaml_cache", False):
+            tidy_call += " --no-yaml-cache"
 
         with open(sadfilename, "w") as sadfile:
             for line in header:
@@ -496,7 +502,7 @@ class SimulationSetup(object):
             + "_preconfig.yaml",
             "w",
         ) as config_file:
-            yaml.dump(self.config, config_file)
+            yaml.dump(self.config, config_file, Dumper=esm_parser.YamlDumper)
 
     def _show_simulation_info(self):
         six.print_(80 * "=")
@@ -518,7 +524,7 @@ class SimulationSetup(object):
             + "_finished_config.yaml",
             "w",
         ) as config_file:
-            yaml.dump(self.config, config_file)
+            yaml.dump(self.config, config_file, Dumper=esm_parser.YamlDumper)
 
     def _create_component_folders(self):
         for component in self.components:
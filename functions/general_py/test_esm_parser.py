@@ -68,5 +68,38 @@ class Test_resolve_basic_choose(unittest.TestCase):
         self.assertEqual(test_dict, result_dict)
 
 
+class Test_ChooseBlock(unittest.TestCase):
+    def setUp(self):
+        self.cases = {36: {"a": "choice one"}, "*": {"a": "default", "b": 1}}
+        self.block = esm_parser.ChooseBlock(
+            "choose_computer.cores_per_node", self.cases, ["echam", "computer"], "echam"
+        )
+
+    def test_compiled(self):
+        self.assertEqual(self.block.selector, ("computer", "cores_per_node"))
+        self.assertTrue(self.block.has_default)
+        self.assertEqual(self.block.default, {"a": "default", "b": 1})
+        self.assertEqual(self.block.set_variables, set(["a", "b"]))
+
+    def test_choice(self):
+        config = {"computer": {"cores_per_node": 36}}
+        self.assertEqual(self.block.choice(config), 36)
+        self.assertRaises(ValueError, self.block.choice, {"computer": {}})
+
+    def test_resolve_with_block(self):
+        config = {
+            "echam": {"choose_computer.cores_per_node": self.cases},
+            "computer": {"cores_per_node": 42},
+        }
+        applied = esm_parser.resolve_basic_choose(
+            config,
+            config["echam"],
+            "choose_computer.cores_per_node",
+            block=self.block,
+        )
+        self.assertEqual(applied, {"a": "default", "b": 1})
+        self.assertEqual(config["echam"], {"a": "default", "b": 1})
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,8 +1,16 @@
 """
 Tests for the ESM-Config YAML Parser
 """
+import copy
 import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
+import warnings
 
 try:
     import unittest.mock as mock
@@ -16,10 +24,39 @@ except ImportError:
     except ImportError:
         mock_avail = False
 
+import esm_cache
 import esm_parser
 from esm_calendar import Date
 
 
+def use_temporary_caches(test_case):
+    """
+    Points the persistent caches of ``esm_parser`` (and ``ESM_CACHE_DIR``)
+    at a fresh temporary directory for one test, and puts everything back
+    afterwards.
+    """
+    directory = tempfile.mkdtemp()
+    test_case.addCleanup(shutil.rmtree, directory)
+    test_case.addCleanup(esm_parser.use_yaml_cache, True)
+    if "ESM_CACHE_DIR" in os.environ:
+        test_case.addCleanup(
+            os.environ.__setitem__, "ESM_CACHE_DIR", os.environ["ESM_CACHE_DIR"]
+        )
+    else:
+        test_case.addCleanup(os.environ.pop, "ESM_CACHE_DIR", None)
+    os.environ["ESM_CACHE_DIR"] = directory
+    test_case.addCleanup(setattr, esm_cache, "CACHE_DIR", esm_cache.CACHE_DIR)
+    esm_cache.CACHE_DIR = directory
+    for name, cache_name in [
+        ("YAML_DISK_CACHE", "yaml"),
+        ("MERGED_CONFIG_CACHE", "merged_configs"),
+        ("MACHINE_CONFIG_CACHE", "machine_configs"),
+    ]:
+        test_case.addCleanup(setattr, esm_parser, name, getattr(esm_parser, name))
+        setattr(esm_parser, name, esm_cache.PickleCache(cache_name))
+    esm_parser.clear_yaml_cache()
+
+
 class Test_module_constants(unittest.TestCase):
     def test_constant_types(self):
         self.assertIsInstance(esm_parser.DATE_MARKER, str)
@@ -27,6 +64,9 @@ class Test_module_constants(unittest.TestCase):
 
 
 class Test_yaml_file_to_dict(unittest.TestCase):
+    def setUp(self):
+        use_temporary_caches(self)
+
     def test_yaml_file_to_dict(self):
         """Tests extension expansion and loading of YAML documents"""
         document = """
@@ -58,6 +98,613 @@ class Test_yaml_file_to_dict(unittest.TestCase):
             os.remove("test.hjkl")
 
 
+class Test_persistent_yaml_cache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        use_temporary_caches(self)
+        self.yaml_path = os.path.join(self.tmpdir, "test.yaml")
+        with open(self.yaml_path, "w") as test_file:
+            test_file.write("model: echam\nresolution: T63\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_second_load_is_a_hit(self):
+        cache = esm_parser.YAML_DISK_CACHE
+        first = esm_parser.yaml_file_to_dict(self.yaml_path)
+        esm_parser.clear_yaml_cache()
+        second = esm_parser.yaml_file_to_dict(self.yaml_path)
+        self.assertEqual(first, second)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_changed_file_is_parsed_again(self):
+        esm_parser.yaml_file_to_dict(self.yaml_path)
+        with open(self.yaml_path, "w") as test_file:
+            test_file.write("model: fesom\n")
+        self.assertEqual(
+            esm_parser.yaml_file_to_dict(self.yaml_path), {"model": "fesom"}
+        )
+        self.assertEqual(esm_parser.YAML_DISK_CACHE.hits, 0)
+
+    def test_disabled_cache(self):
+        esm_parser.use_yaml_cache(False)
+        esm_parser.yaml_file_to_dict(self.yaml_path)
+        esm_parser.clear_yaml_cache()
+        esm_parser.yaml_file_to_dict(self.yaml_path)
+        cache = esm_parser.YAML_DISK_CACHE
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+
+    def test_evicts_least_recently_used(self):
+        cache = esm_cache.PickleCache(
+            "lru", max_size=1, directory=os.path.join(self.tmpdir, "lru")
+        )
+        cache.put("old", None, "x" * 100)
+        cache.put("new", None, "y")
+        self.assertIsNone(cache.get("old", None))
+        self.assertEqual(len(os.listdir(cache.directory)), 0)
+
+
+class Test_load_yaml_file(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.yaml_path = os.path.join(self.tmpdir, "test.yaml")
+        with open(self.yaml_path, "w") as test_file:
+            test_file.write("model: echam\nforcing_files:\n    sst: sst\n")
+        use_temporary_caches(self)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_parses_once_per_process(self):
+        before = esm_parser.yaml_cache_info()
+        esm_parser.yaml_file_to_dict(self.yaml_path)
+        esm_parser.yaml_file_to_dict(self.yaml_path)
+        after = esm_parser.yaml_cache_info()
+        self.assertEqual(after["misses"] - before["misses"], 1)
+        self.assertEqual(after["hits"] - before["hits"], 1)
+        self.assertEqual(after["documents"], 1)
+
+    def test_hands_out_independent_copies(self):
+        first = esm_parser.yaml_file_to_dict(self.yaml_path)
+        first["forcing_files"]["sic"] = "sic"
+        second = esm_parser.yaml_file_to_dict(self.yaml_path)
+        self.assertEqual(second["forcing_files"], {"sst": "sst"})
+
+
+class Test_parse_yaml(unittest.TestCase):
+    def test_strings_are_interned(self):
+        first = esm_parser.parse_yaml("namelist_changes:\n    grid: T63_grid_file\n")
+        second = esm_parser.parse_yaml("grid: T63_grid_file\n")
+        self.assertIs(list(first["namelist_changes"])[0], list(second)[0])
+        self.assertIs(first["namelist_changes"]["grid"], second["grid"])
+
+    def test_long_strings_are_not_interned(self):
+        long_string = "x" * (esm_parser.YAML_INTERN_MAX_LENGTH + 1)
+        value, saved = esm_parser.intern_string(long_string)
+        self.assertIs(value, long_string)
+        self.assertEqual(saved, 0)
+
+
+class Test_prefetch_config_files(unittest.TestCase):
+    def setUp(self):
+        use_temporary_caches(self)
+
+    def test_lists_included_files(self):
+        included_files = esm_parser.list_included_files(
+            {"general": {"include_models": ["echam"]}, "further_reading": "echam/nope"}
+        )
+        self.assertEqual(
+            included_files, [esm_parser.FUNCTION_PATH + "/echam/echam.yaml"]
+        )
+
+    def test_loads_include_closure(self):
+        esm_parser.prefetch_config_files(
+            [esm_parser.FUNCTION_PATH + "/echam/echam.yaml"]
+        )
+        before = esm_parser.yaml_cache_info()
+        esm_parser.yaml_file_to_dict(esm_parser.FUNCTION_PATH + "/jsbach/jsbach")
+        after = esm_parser.yaml_cache_info()
+        self.assertEqual(after["misses"], before["misses"])
+        self.assertEqual(after["hits"], before["hits"] + 1)
+
+
+class Test_ConfigBundle(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmpdir, "echam"))
+        self.yaml_path = os.path.join(self.tmpdir, "echam", "echam.yaml")
+        with open(self.yaml_path, "w") as test_file:
+            test_file.write("model: echam\n")
+        with open(os.path.join(self.tmpdir, "broken.yaml"), "w") as test_file:
+            test_file.write("model: [echam\n")
+        self.bundle = esm_parser.ConfigBundle(
+            os.path.join(self.tmpdir, "bundle.pickle"), self.tmpdir
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_compile_and_load(self):
+        self.assertEqual(self.bundle.compile(), [os.path.join("echam", "echam.yaml")])
+        bundle = esm_parser.ConfigBundle(self.bundle.path, self.tmpdir)
+        self.assertEqual(
+            bundle.get(self.yaml_path, os.stat(self.yaml_path)), {"model": "echam"}
+        )
+
+    def test_outdated_entry(self):
+        self.bundle.compile()
+        with open(self.yaml_path, "w") as test_file:
+            test_file.write("model: jsbach\n")
+        self.assertIsNone(self.bundle.get(self.yaml_path, os.stat(self.yaml_path)))
+
+    def test_read_once_from_threads(self):
+        self.bundle.compile()
+        bundle = esm_parser.ConfigBundle(self.bundle.path, self.tmpdir)
+        reads = []
+        read = bundle._read
+
+        def slow_read():
+            reads.append(None)
+            time.sleep(0.05)
+            return read()
+
+        bundle._read = slow_read
+        stat = os.stat(self.yaml_path)
+        results = []
+        threads = [
+            threading.Thread(
+                target=lambda: results.append(bundle.get(self.yaml_path, stat))
+            )
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(results, [{"model": "echam"}] * 8)
+
+    def test_counts_from_threads(self):
+        cache = esm_cache.PickleCache(
+            "threads", directory=os.path.join(self.tmpdir, "threads")
+        )
+        cache.put("entry", None, "payload")
+
+        def look_up():
+            for _ in range(100):
+                cache.get("entry", None)
+                cache.get("missing", None)
+
+        threads = [threading.Thread(target=look_up) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((cache.hits, cache.misses), (800, 800))
+
+
+class Test_ConfigFileIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name in ["echam.yaml", "echam.yml", "fesom.yaml"]:
+            with open(os.path.join(self.tmpdir, name), "w") as test_file:
+                test_file.write("model: test\n")
+        # Make sure that any later change updates the modification time:
+        os.utime(self.tmpdir, (0, 0))
+        self.index = esm_parser.ConfigFileIndex([self.tmpdir])
+        self.extensions = esm_parser.YAML_AUTO_EXTENSIONS
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_finds_extensions_in_order(self):
+        self.assertEqual(
+            self.index.find(os.path.join(self.tmpdir, "echam"), self.extensions),
+            os.path.join(self.tmpdir, "echam.yml"),
+        )
+        self.assertIsNone(self.index.find(os.path.join(self.tmpdir, "fesom")))
+
+    def test_missing_file(self):
+        self.assertIsNone(
+            self.index.find(os.path.join(self.tmpdir, "jsbach"), self.extensions)
+        )
+
+    def test_finds_new_files(self):
+        self.index.find(os.path.join(self.tmpdir, "echam"), self.extensions)
+        with open(os.path.join(self.tmpdir, "jsbach.yaml"), "w") as test_file:
+            test_file.write("model: jsbach\n")
+        self.assertEqual(
+            self.index.find(os.path.join(self.tmpdir, "jsbach"), self.extensions),
+            os.path.join(self.tmpdir, "jsbach.yaml"),
+        )
+
+    def test_forget_removed_files(self):
+        self.index.find(os.path.join(self.tmpdir, "echam"), self.extensions)
+        os.remove(os.path.join(self.tmpdir, "echam.yml"))
+        self.index.forget(os.path.join(self.tmpdir, "echam.yml"))
+        self.assertEqual(
+            self.index.find(os.path.join(self.tmpdir, "echam"), self.extensions),
+            os.path.join(self.tmpdir, "echam.yaml"),
+        )
+
+
+class Test_resolve_choose_blocks(unittest.TestCase):
+    def setUp(self):
+        use_temporary_caches(self)
+        self.config = {
+            "general": {
+                "resolution": "LR",
+                "choose_general.resolution": {
+                    "LR": {"coupling_time_step": 3600},
+                    "MR": {"coupling_time_step": 1800},
+                },
+            },
+            "echam": {
+                "model": "echam",
+                "scenario": "PI-CTRL",
+                "choose_resolution": {
+                    "T63": {"levels": "L47", "nproca": 24},
+                    "T127": {"levels": "L95", "nproca": 48},
+                },
+                "choose_scenario": {
+                    "PI-CTRL": {
+                        "resolution": "T63",
+                        "choose_levels": {
+                            "L47": {"time_step": 450},
+                            "*": {"time_step": 200},
+                        },
+                    },
+                    "*": {"resolution": "T127"},
+                },
+                "choose_general.resolution": {
+                    "LR": {"nprocb": 24},
+                    "MR": {"nprocb": 48},
+                },
+            },
+            "fesom": {
+                "model": "fesom",
+                "mesh": "CORE2",
+                "choose_echam.levels": {
+                    "L47": {"leapyear": True},
+                    "*": {"leapyear": False},
+                },
+                "choose_mesh": {"CORE2": {"nproc": 288, "time_step": 1800}},
+            },
+        }
+
+    def test_same_result_as_before(self):
+        # The result of the previous, rescanning implementation:
+        expected = {
+            "general": {"resolution": "LR", "coupling_time_step": 3600},
+            "echam": {
+                "model": "echam",
+                "scenario": "PI-CTRL",
+                "nprocb": 24,
+                "resolution": "T63",
+                "levels": "L47",
+                "nproca": 24,
+                "time_step": 450,
+            },
+            "fesom": {
+                "model": "fesom",
+                "mesh": "CORE2",
+                "leapyear": True,
+                "nproc": 288,
+                "time_step": 1800,
+            },
+        }
+        esm_parser.resolve_choose_blocks(self.config)
+        self.assertEqual(self.config, expected)
+        for name in expected:
+            self.assertEqual(list(self.config[name]), list(expected[name]))
+
+    def test_cyclic_dependency(self):
+        self.config["echam"]["choose_resolution"]["T63"]["scenario"] = "PI-CTRL"
+        self.assertRaises(
+            KeyError, esm_parser.resolve_choose_blocks, self.config
+        )
+
+    def test_all_cycles_reported_before_resolving(self):
+        self.config["echam"]["choose_resolution"]["T63"]["scenario"] = "PI-CTRL"
+        self.config["fesom"]["choose_mesh"]["CORE2"]["mesh"] = "CORE2"
+        with self.assertRaises(KeyError) as context:
+            esm_parser.resolve_choose_blocks(self.config)
+        message = str(context.exception)
+        self.assertIn(
+            "echam.choose_echam.resolution -> echam.choose_echam.scenario"
+            " -> echam.choose_echam.resolution",
+            message,
+        )
+        self.assertIn("fesom.choose_fesom.mesh -> fesom.choose_fesom.mesh", message)
+        # Not even the independent blocks were resolved:
+        self.assertNotIn("coupling_time_step", self.config["general"])
+
+    def test_memo(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        memo = esm_cache.PickleCache("choose_outcomes", directory=directory)
+        expected = copy.deepcopy(self.config)
+        esm_parser.resolve_choose_blocks(expected)
+        results = []
+        for _ in range(2):
+            config = copy.deepcopy(self.config)
+            esm_parser.resolve_choose_blocks(config, memo=memo)
+            results.append(config)
+        self.assertEqual(memo.misses, 1)
+        self.assertEqual(memo.hits, 1)
+        for config in results:
+            self.assertEqual(config, expected)
+            for name in expected:
+                self.assertEqual(list(config[name]), list(expected[name]))
+
+    def test_memo_other_choices(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        memo = esm_cache.PickleCache("choose_outcomes", directory=directory)
+        esm_parser.resolve_choose_blocks(copy.deepcopy(self.config), memo=memo)
+        # A later chunk, choosing another scenario:
+        self.config["echam"]["scenario"] = "1950"
+        expected = copy.deepcopy(self.config)
+        esm_parser.resolve_choose_blocks(expected)
+        counters = dict(esm_parser.counters)
+        esm_parser.resolve_choose_blocks(self.config, memo=memo)
+        self.assertEqual(self.config, expected)
+        for name in expected:
+            self.assertEqual(list(self.config[name]), list(expected[name]))
+        self.assertEqual(self.config["echam"]["resolution"], "T127")
+        # Both blocks choosing on general.resolution come first, and are
+        # taken over:
+        for name, increment in [
+            ("choose memo misses", 1),
+            ("choose memo steps reused", 2),
+        ]:
+            self.assertEqual(
+                esm_parser.counters.get(name, 0), counters.get(name, 0) + increment
+            )
+
+    def test_memo_in_experiment(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(
+            setattr, esm_parser, "USE_CHOOSE_MEMO", esm_parser.USE_CHOOSE_MEMO
+        )
+        esm_parser.USE_CHOOSE_MEMO = True
+        self.assertIsNone(esm_parser.choose_memo(self.config))
+        self.config["general"]["experiment_config_dir"] = directory + "/config/"
+        memo = esm_parser.choose_memo(self.config)
+        self.assertEqual(
+            memo.directory,
+            os.path.join(directory, "config", esm_parser.CHOOSE_MEMO_DIR),
+        )
+        esm_parser.resolve_choose_blocks(self.config, memo=memo)
+        self.assertTrue(os.listdir(memo.directory))
+
+    def test_memo_not_used_is_logged(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.addCleanup(
+            setattr, esm_parser, "USE_CHOOSE_MEMO", esm_parser.USE_CHOOSE_MEMO
+        )
+        esm_parser.USE_CHOOSE_MEMO = True
+        with self.assertLogs(esm_parser.logger, "DEBUG") as logs:
+            self.assertIsNone(esm_parser.choose_memo(self.config))
+        self.assertIn("experiment_config_dir", logs.output[0])
+        if not mock_avail:
+            self.skipTest("mock is not available")
+        self.config["general"]["experiment_config_dir"] = directory + "/config/"
+        with mock.patch("os.access", return_value=False):
+            with self.assertLogs(esm_parser.logger, "WARNING") as logs:
+                self.assertIsNone(esm_parser.choose_memo(self.config))
+        self.assertIn(directory + " can not be written", logs.output[0])
+
+    def test_cycle_files(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "fesom.yaml")
+        with open(path, "w") as yaml_file:
+            yaml_file.write("choose_mesh:\n  CORE2:\n    mesh: CORE2\n")
+        cycles = [[("fesom", "choose_fesom.mesh"), ("fesom", "choose_fesom.mesh")]]
+        message = esm_parser.describe_choose_cycles(cycles, [path])
+        self.assertIn(os.path.relpath(path, esm_parser.FUNCTION_PATH), message)
+        message = esm_parser.describe_choose_cycles(cycles, [])
+        self.assertNotIn("defined in", message)
+
+
+class Test_dict_merge(unittest.TestCase):
+    def test_merges_nested_dicts(self):
+        config = {"echam": {"lresume": False, "namelist_changes": {"a": 1}}}
+        touched = esm_parser.dict_merge(
+            config, {"echam": {"lresume": True, "namelist_changes": {"b": 2}}}
+        )
+        self.assertEqual(
+            config,
+            {"echam": {"lresume": True, "namelist_changes": {"a": 1, "b": 2}}},
+        )
+        self.assertEqual(touched, 4)
+
+    def test_replaces_non_dicts(self):
+        config = {"echam": {"grid": "T63"}, "fesom": "off"}
+        esm_parser.dict_merge(config, {"echam": {"grid": {"res": 63}}, "fesom": {}})
+        self.assertEqual(config, {"echam": {"grid": {"res": 63}}, "fesom": {}})
+
+    def test_deeper_than_recursion_limit(self):
+        depth = sys.getrecursionlimit() + 100
+        config, merge_config = {}, {}
+        target, source = config, merge_config
+        for _ in range(depth):
+            target["level"], source["level"] = {}, {}
+            target, source = target["level"], source["level"]
+        source["leaf"] = True
+        self.assertEqual(esm_parser.dict_merge(config, merge_config), depth + 1)
+        self.assertTrue(target["leaf"])
+
+
+class Test_file_stats_match(unittest.TestCase):
+    def setUp(self):
+        handle, self.path = tempfile.mkstemp(suffix=".yaml")
+        with os.fdopen(handle, "w") as test_file:
+            test_file.write("model: echam\n")
+        self.file_stats = esm_parser._file_stats([self.path])
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def test_unchanged(self):
+        self.assertTrue(esm_parser._file_stats_match(self.file_stats))
+
+    def test_changed(self):
+        with open(self.path, "w") as test_file:
+            test_file.write("model: fesom\n")
+        # Same size; the modification time has to differ:
+        mtime = self.file_stats[0][1] + 1
+        os.utime(self.path, (mtime, mtime))
+        self.assertFalse(esm_parser._file_stats_match(self.file_stats))
+
+    def test_removed(self):
+        os.remove(self.path)
+        self.assertFalse(esm_parser._file_stats_match(self.file_stats))
+
+
+class Test_NestedKeyIndex(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            "echam": {
+                "add_forcing_files": {"sst": "amip"},
+                "remove_forcing_files": ["ozone"],
+                "forcing_files": {"sst": "pisst", "ozone": "ozone"},
+            },
+            "general": {"resolution": "T63", "nested": {"resolution": "T127"}},
+        }
+        self.index = esm_parser.NestedKeyIndex(self.config)
+
+    def test_find(self):
+        self.assertEqual(self.index.find("resolution"), "T63")
+        self.assertEqual(self.index.find("resolution", ("general", "nested")), "T127")
+        self.assertRaises(KeyError, self.index.find, "resolution", ("echam",))
+
+    def test_deleted_keys_are_skipped(self):
+        del self.config["general"]["resolution"]
+        self.assertEqual(self.index.find("resolution"), "T127")
+
+    def test_delete(self):
+        esm_parser.del_value_for_nested_key(self.config, "resolution", self.index)
+        self.assertEqual(self.config["general"], {"nested": {}})
+
+    def test_same_entries_as_scan(self):
+        for finder in (
+            esm_parser.find_add_entries_in_config,
+            esm_parser.find_remove_entries_in_config,
+        ):
+            self.assertEqual(
+                finder(self.config["echam"], "echam", self.index),
+                finder(self.config["echam"], "echam"),
+            )
+
+    def test_add_and_remove(self):
+        expected = copy.deepcopy(self.config)
+        names = list(expected)
+        esm_parser.add_entries_to_chapter_in_config(expected, names, expected, names)
+        esm_parser.remove_entries_from_chapter_in_config(
+            expected, names, expected, names
+        )
+        esm_parser._add_and_remove_entries(self.config, names, self.index)
+        self.assertEqual(self.config, expected)
+        self.assertEqual(self.config["echam"]["forcing_files"], {"sst": "amip"})
+
+    def test_kept_up_to_date(self):
+        # Merged, re-inserted and deleted keys, as choose_ cases leave them:
+        esm_parser.dict_merge(
+            self.config,
+            {"fesom": {"add_namelist": {"a": 1}}, "echam": {"add_x": [1]}},
+            self.index,
+        )
+        esm_parser.dict_merge(
+            self.config["echam"],
+            {"nested": {"remove_y": ["z"]}},
+            self.index,
+            ("echam",),
+        )
+        self.config["echam"]["add_forcing_files"] = self.config["echam"].pop(
+            "add_forcing_files"
+        )
+        del self.config["echam"]["remove_forcing_files"]
+        index = esm_parser.NestedKeyIndex(self.config)
+        for prefix in ("add_", "remove_"):
+            self.assertEqual(self.index.prefixed(prefix), index.prefixed(prefix))
+            self.assertEqual(
+                self.index.prefixed(prefix, ("echam",)),
+                index.prefixed(prefix, ("echam",)),
+            )
+
+
+class Test_find_value_for_nested_key(unittest.TestCase):
+    def test_only_looks_at_the_dict_at_tree(self):
+        config = {"general": {"resolution": "T63", "nested": {"grid": "T127"}}}
+        self.assertEqual(
+            esm_parser.find_value_for_nested_key(config, "resolution", ["general"]),
+            "T63",
+        )
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            self.assertIsNone(
+                esm_parser.find_value_for_nested_key(config, "resolution")
+            )
+            self.assertIsNone(
+                esm_parser.find_value_for_nested_key(config, "grid", ["general"])
+            )
+
+
+class Test_finish_priority_merge(unittest.TestCase):
+    def test_renames_marked_keys(self):
+        marker = esm_parser.priority_marker
+        config = {
+            "echam": {
+                "lresume": False,
+                "lresume" + marker: True,
+                "namelist_changes": {"grid" + marker: "T63"},
+            },
+            "general" + marker: {"expid": "test"},
+        }
+        self.assertEqual(len(esm_parser.list_all_keys_with_priority_marker(config)), 3)
+        self.assertEqual(esm_parser.finish_priority_merge(config), 3)
+        self.assertEqual(
+            config,
+            {
+                "echam": {"lresume": True, "namelist_changes": {"grid": "T63"}},
+                "general": {"expid": "test"},
+            },
+        )
+        self.assertEqual(esm_parser.list_all_keys_with_priority_marker(config), [])
+
+    def test_100k_keys(self):
+        marker = esm_parser.priority_marker
+        config = {}
+        for chapter in range(100):
+            config["chapter_%d" % chapter] = chapter_config = {}
+            for section in range(100):
+                chapter_config["section_%d" % section] = section_config = {}
+                for entry in range(10):
+                    key = "entry_%d" % entry
+                    if entry % 2:
+                        key += marker
+                    section_config[key] = entry
+        self.assertEqual(esm_parser.finish_priority_merge(config), 50000)
+        self.assertEqual(config["chapter_99"]["section_99"]["entry_9"], 9)
+        self.assertEqual(esm_parser.list_all_keys_with_priority_marker(config), [])
+
+    def test_deeply_nested(self):
+        marker = esm_parser.priority_marker
+        config = inner = {}
+        for level in range(sys.getrecursionlimit() * 2):
+            inner["level" + marker] = inner = {}
+        inner["entry" + marker] = 1
+        self.assertEqual(
+            esm_parser.finish_priority_merge(config), sys.getrecursionlimit() * 2 + 1
+        )
+        self.assertEqual(esm_parser.list_all_keys_with_priority_marker(config), [])
+
+
 class Test_attach_to_config_and_remove(unittest.TestCase):
     def setUp(self):
         self.config = {}
@@ -186,6 +833,181 @@ class Test_find_variable(unittest.TestCase):
         )
         self.assertEqual(r, "${lresume}")
 
+    def test_stops_at_first_variable_not_replaced(self):
+        tdict = {"general": {"lresume": True, "expid": "test"}}
+        r = esm_parser.find_variable(
+            ["general", "lala"],
+            "${expid}/${lresume}/${expid}",
+            tdict,
+            [re.compile("lresume")],
+            isblacklist=True,
+        )
+        self.assertEqual(r, "test/${lresume}/${expid}")
+
+    def test_value_with_variable_is_replaced(self):
+        tdict = {"general": {"a": "${b}", "b": "$", "c": "x"}}
+        r = esm_parser.find_variable(
+            ["general", "lala"], "${a}{c}", tdict, [], isblacklist=True
+        )
+        self.assertEqual(r, "x")
+
+    def test_list_is_returned(self):
+        tdict = {"general": {"a": [1, 2]}}
+        r = esm_parser.find_variable(
+            ["general", "lala"], "x ${a} y", tdict, [], isblacklist=True
+        )
+        self.assertEqual(r, [1, 2])
+
+    def test_unclosed_variable(self):
+        tdict = {"general": {"a": "1"}}
+        with self.assertRaises(ValueError):
+            esm_parser.find_variable(
+                ["general", "lala"], "${a} ${a", tdict, [], isblacklist=True
+            )
+
+
+class Test_compile_template(unittest.TestCase):
+    def test_splits_variables(self):
+        template = esm_parser.compile_template("a${b}c${d!syear}")
+        self.assertEqual(template.variables, [(1, "b", 5), (6, "d!syear", 16)])
+        self.assertFalse(template.unterminated)
+        self.assertIs(template, esm_parser.compile_template("a${b}c${d!syear}"))
+
+    def test_replaceable(self):
+        template = esm_parser.compile_template("${a}${lresume}${b}")
+        self.assertEqual(template.replaceable([re.compile("lresume")], True), 1)
+        self.assertEqual(template.replaceable([], True), 3)
+
+
+class Test_determine_regex_list_match(unittest.TestCase):
+    def setUp(self):
+        self.regex_list = [
+            re.compile(entry) for entry in [r".*version", r".*_dir", r"lresume"]
+        ]
+
+    def test_same_result_as_each_regex(self):
+        for test_str in ["echam_version", "work_dir", "lresume", "dir_work", "x"]:
+            self.assertEqual(
+                esm_parser.determine_regex_list_match(test_str, self.regex_list),
+                any(regex.match(test_str) for regex in self.regex_list),
+            )
+        self.assertFalse(esm_parser.determine_regex_list_match("lresume", []))
+
+    def test_backreferences(self):
+        matcher = esm_parser.RegexListMatcher([re.compile(r"(a)\1"), re.compile("b")])
+        self.assertTrue(matcher.match("aa"))
+        self.assertFalse(matcher.match("ab"))
+
+    def test_bounded_cache(self):
+        matcher = esm_parser.RegexListMatcher(self.regex_list, max_size=2)
+        counters = dict(esm_parser.counters)
+        for test_str in ["a_dir", "b_dir", "a_dir", "c_dir", "b_dir"]:
+            self.assertTrue(matcher.match(test_str))
+        self.assertEqual(list(matcher._results), ["c_dir", "b_dir"])
+        self.assertEqual(
+            esm_parser.counters["regex list match cache hits"],
+            counters.get("regex list match cache hits", 0) + 1,
+        )
+
+
+class Test_resolve_variables(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            "general": {"expid": "test", "base_dir": "/work", "chunks": [1, 2]},
+            "echam": {
+                "forcing_dir": "${input_dir}/forcing",
+                "input_dir": "${pool_dir}/input",
+                "pool_dir": "${general.base_dir}/pool",
+                "files": ["${forcing_dir}/sst", "${input_dir}/${expid}"],
+                "chunks": "${general.chunks}",
+                "nproc": 4,
+            },
+        }
+
+    def test_same_result_as_find_variable(self):
+        expected = copy.deepcopy(self.config)
+        esm_parser.recursive_run_function(
+            [], expected, "atomic", esm_parser.find_variable, expected, [], True
+        )
+        esm_parser.resolve_variables(self.config, [], True)
+        self.assertEqual(self.config, expected)
+        self.assertEqual(
+            self.config["echam"]["files"][0], "/work/pool/input/forcing/sst"
+        )
+
+    def test_each_variable_resolved_once(self):
+        counters = dict(esm_parser.counters)
+        esm_parser.resolve_variables(self.config, [], True)
+        self.assertEqual(
+            esm_parser.counters["variables resolved"],
+            counters.get("variables resolved", 0) + 6,
+        )
+
+    def test_memo(self):
+        counters = dict(esm_parser.counters)
+        esm_parser.resolve_variables(self.config, [], True)
+        # ${input_dir} is used twice in echam, and looked up only once:
+        self.assertEqual(
+            esm_parser.counters["variable memo hits"],
+            counters.get("variable memo hits", 0) + 1,
+        )
+
+    def test_keys(self):
+        config = {
+            "general": {"res": "T63", "key": "res"},
+            "echam": {"${res}_a": 1, "${key}": "T127", "${res}_b": 2},
+        }
+        expected = copy.deepcopy(config)
+        esm_parser.recursive_run_function(
+            [], expected, "keys", esm_parser.find_variable, expected, [], True
+        )
+        esm_parser.resolve_variables_in_keys(config, [], True)
+        self.assertEqual(config, expected)
+        # The renamed key is used from then on:
+        self.assertEqual(config["echam"], {"T63_a": 1, "res": "T127", "T127_b": 2})
+
+    def test_cycles_reported_before_resolving(self):
+        self.config["echam"]["pool_dir"] = "${forcing_dir}/pool"
+        self.config["general"]["expid"] = "${expid}"
+        with self.assertRaises(KeyError) as context:
+            esm_parser.resolve_variables(self.config, [], True)
+        message = str(context.exception)
+        self.assertIn("general.expid -> general.expid", message)
+        self.assertIn(
+            "echam.forcing_dir -> echam.input_dir -> echam.pool_dir -> "
+            "echam.forcing_dir",
+            message,
+        )
+        self.assertEqual(self.config["echam"]["files"][1], "${input_dir}/${expid}")
+
+
+    def test_overridden_variable_same_as_find_variable(self):
+        # echam.res overrides general.res, and is used before it is set:
+        config = {
+            "general": {"res": "T63", "grid": "${res}"},
+            "echam": {"grid": "${res}", "res": "${general.res}_echam"},
+        }
+        expected = copy.deepcopy(config)
+        esm_parser.recursive_run_function(
+            [], expected, "atomic", esm_parser.find_variable, expected, [], True
+        )
+        esm_parser.resolve_variables(config, [], True)
+        self.assertEqual(config, expected)
+        self.assertEqual(config["echam"]["grid"], "T63_echam")
+        self.assertEqual(config["general"]["grid"], "T63")
+
+    def test_value_of_other_chapter_resolved_in_its_chapter(self):
+        # Intended change: find_variable looked up ${z} in general, where it
+        # is not set, unless echam came first:
+        for names in (["general", "echam"], ["echam", "general"]):
+            chapters = {
+                "general": {"x": "${echam.y}"},
+                "echam": {"y": "${z}", "z": "1"},
+            }
+            config = dict((name, chapters[name]) for name in names)
+            esm_parser.resolve_variables(config, [], True)
+            self.assertEqual(config["general"]["x"], "1")
+
 
 class Test_actually_find_variable(unittest.TestCase):
     def test_finds_answer_with_sensible_input(self):
@@ -213,6 +1035,73 @@ class Test_actually_find_variable(unittest.TestCase):
         )
 
 
+class Test_ConfigPathIndex(unittest.TestCase):
+    def setUp(self):
+        self.config = {
+            "computer": {"pool_directories": {"pool": "/pool"}, "cores": [1, 2]},
+            "echam": {"resolution": "T63"},
+            "general": {"expid": "test"},
+        }
+        self.index = esm_parser.ConfigPathIndex(self.config)
+
+    def test_lookup(self):
+        mapping, key = self.index.lookup(["computer", "pool_directories", "pool"])
+        self.assertEqual(mapping[key], "/pool")
+        self.assertIsNone(self.index.lookup(["computer", "cores", "0"]))
+        self.assertIsNone(self.index.lookup(["echam", "expid"]))
+
+    def test_changed_values_are_seen(self):
+        self.config["echam"]["resolution"] = "T127"
+        mapping, key = self.index.lookup(["echam", "resolution"])
+        self.assertEqual(mapping[key], "T127")
+
+    def test_same_result_as_without_index(self):
+        tree = ["echam", "something"]
+        for rhs in ["resolution", "echam.resolution", "expid", "computer.cores"]:
+            self.assertEqual(
+                esm_parser.actually_find_variable(tree, rhs, self.config, self.index),
+                esm_parser.actually_find_variable(tree, rhs, self.config),
+            )
+        self.assertRaises(
+            ValueError,
+            esm_parser.actually_find_variable,
+            tree,
+            "nonsense",
+            self.config,
+            self.index,
+        )
+
+    def test_replace(self):
+        pool = self.config["computer"]["pool_directories"]
+        self.index.replace(["computer", "pool_directories"], {"dirs": pool})
+        del self.config["computer"]["pool_directories"]
+        self.config["computer"]["dirs"] = pool
+        self.assertIsNone(self.index.lookup(["computer", "pool_directories"]))
+        self.assertIsNone(
+            self.index.lookup(["computer", "pool_directories", "pool"])
+        )
+        mapping, key = self.index.lookup(["computer", "dirs", "pool"])
+        self.assertEqual(mapping[key], "/pool")
+
+    def test_renamed_keys(self):
+        self.config["echam"]["${general.expid}_dir"] = {"out": "/out"}
+        self.config["echam"]["path"] = "${echam.test_dir.out}"
+        self.index = esm_parser.ConfigPathIndex(self.config)
+        esm_parser.resolve_variables_in_keys(self.config, [], True, self.index)
+        self.assertEqual(
+            esm_parser.find_variable(
+                ["echam", "path"],
+                self.config["echam"]["path"],
+                self.config,
+                [],
+                True,
+                self.index,
+            ),
+            "/out",
+        )
+        self.assertIsNone(self.index.lookup(["echam", "${general.expid}_dir"]))
+
+
 class Test_list_to_multikey(unittest.TestCase):
     def test_skips_func_if_bad_tree(self):
         r = esm_parser.list_to_multikey(
@@ -403,6 +1292,9 @@ class Test_list_to_multikey(unittest.TestCase):
 
 
 class Test_determine_computer_from_hostname(unittest.TestCase):
+    def setUp(self):
+        use_temporary_caches(self)
+
     def test_loads_generic(self):
         if not mock_avail:
             self.skipTest()
@@ -431,6 +1323,55 @@ class Test_determine_computer_from_hostname(unittest.TestCase):
             )
 
 
+class Test_resolve_machine_config(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "machine.yaml")
+        with open(self.path, "w") as yaml_file:
+            yaml_file.write(
+                "name: machine\n"
+                "partition: compute\n"
+                "choose_partition:\n"
+                "  compute:\n"
+                "    cores_per_node: 36\n"
+                "  \"*\":\n"
+                "    cores_per_node: 1\n"
+                "hostfile: ${name}_${cores_per_node}\n"
+            )
+        use_temporary_caches(self)
+        esm_parser._machine_configs.clear()
+
+    def tearDown(self):
+        esm_parser._machine_configs.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def test_resolved(self):
+        config = esm_parser.resolve_machine_config(self.path)
+        self.assertEqual(config["cores_per_node"], 36)
+        self.assertEqual(config["hostfile"], "machine_36")
+        self.assertNotIn("choose_partition", config)
+
+    def test_cached(self):
+        expected = esm_parser.resolve_machine_config(self.path)
+        expected["hostfile"] = "modified"
+        self.assertEqual(
+            esm_parser.resolve_machine_config(self.path)["hostfile"], "machine_36"
+        )
+        esm_parser._machine_configs.clear()
+        config = esm_parser.resolve_machine_config(self.path)
+        self.assertEqual(config["hostfile"], "machine_36")
+        self.assertEqual(esm_parser.MACHINE_CONFIG_CACHE.misses, 1)
+        self.assertEqual(esm_parser.MACHINE_CONFIG_CACHE.hits, 1)
+
+    def test_changed(self):
+        esm_parser.resolve_machine_config(self.path)
+        with open(self.path, "a") as yaml_file:
+            yaml_file.write("partition: other\n")
+        esm_parser.clear_yaml_cache()
+        config = esm_parser.resolve_machine_config(self.path)
+        self.assertEqual(config["cores_per_node"], 1)
+
+
 class Test_do_math_in_entry(unittest.TestCase):
     def setUp(self):
         self.math_test_dict = {